@@ -0,0 +1,105 @@
+import os
+import sys
+from pathlib import Path
+from colorama import Fore
+
+sys.path.append(str(Path(__file__).parent.parent))
+from common.config import *
+from common.utility import *
+
+# Per-job budget on shared nodes, never more than the affinity mask and cgroup limits allow
+CORES_ENV = "UKMO_CORES"
+MEMORY_ENV = "UKMO_MEMORY_GB"
+
+# Read by OpenMP, MKL, OpenBLAS and numexpr when they load, so processes started after
+# set_thread_env get their thread pools sized from the plan
+THREAD_ENV = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'NUMEXPR_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS']
+
+CGROUP_CPU = "/sys/fs/cgroup/cpu.max"
+CGROUP_MEMORY = ["/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"]
+
+
+def cpu_budget():
+    # Cores this process may run on, respects taskset/cgroup affinity unlike os.cpu_count()
+    if hasattr(os, 'sched_getaffinity'):
+        cores = len(os.sched_getaffinity(0))
+    else:
+        cores = os.cpu_count()
+
+    # cgroup v2 quota, "max 100000" when unlimited
+    try:
+        quota, period = Path(CGROUP_CPU).read_text().split()
+        if quota != 'max':
+            cores = min(cores, max(1, int(quota) // int(period)))
+    except (OSError, ValueError):
+        pass
+
+    if os.environ.get(CORES_ENV):
+        cores = min(cores, max(1, int(os.environ[CORES_ENV])))
+    return cores
+
+
+def memory_budget():
+    limits = []
+
+    try:
+        with open("/proc/meminfo", 'r') as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    limits.append(int(line.split()[1]) * 1024)
+    except OSError:
+        limits.append(os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES'))
+
+    for path in CGROUP_MEMORY:
+        try:
+            value = Path(path).read_text().strip()
+            if value.isdigit():
+                limits.append(int(value))
+        except OSError:
+            pass
+
+    if os.environ.get(MEMORY_ENV):
+        limits.append(int(float(os.environ[MEMORY_ENV]) * 2**30))
+    return min(limits)
+
+
+def plan_workers(workers=None, threads=None, worker_memory=0, reserve=0):
+    # Processes and threads per process for one stage, processes × threads stays within the core budget
+    # and processes × worker_memory within the memory budget. `reserve` cores are left to the parent.
+    cores = max(1, cpu_budget() - reserve)
+    limit = cores
+
+    if worker_memory:
+        limit = min(limit, max(1, memory_budget() // worker_memory))
+
+    planned = min(workers or cores, limit)
+    if workers and planned < workers:
+        print_log(f"Resource budget allows {planned} of {workers} requested processes", Fore.YELLOW)
+
+    planned_threads = max(1, cores // planned)
+    if threads and threads > planned_threads:
+        print_log(f"Resource budget allows {planned_threads} of {threads} requested threads per process", Fore.YELLOW)
+    elif threads:
+        planned_threads = threads
+
+    return planned, planned_threads
+
+
+def set_thread_env(threads):
+    for name in THREAD_ENV:
+        os.environ[name] = str(threads)
+
+
+def limit_threads(threads):
+    # For pool workers: libraries loaded from now on read the environment, torch (when already
+    # imported, e.g. in a forked child) is resized directly
+    set_thread_env(threads)
+
+    if 'torch' in sys.modules:
+        sys.modules['torch'].set_num_threads(threads)
+
+
+def print_plan(stage, processes, threads):
+    print_log(
+        f"{stage}: {processes} processes x {threads} threads "
+        f"(budget {cpu_budget()} cores, {memory_budget() / 2**30:.1f} GB)", Fore.CYAN)
@@ -0,0 +1,154 @@
+import os
+import sys
+import json
+import shutil
+import time
+import atexit
+import threading
+import functools
+import multiprocessing
+import multiprocessing.util
+from pathlib import Path
+from contextlib import contextmanager
+from colorama import Fore
+
+sys.path.append(str(Path(__file__).parent.parent))
+from common.config import *
+from common.utility import *
+
+# Opt-in: UKMO_TRACE=download/trace.json records spans in this process and every process it starts,
+# merged into one Chrome trace (chrome://tracing, ui.perfetto.dev) when the first one exits
+TRACE_ENV = "UKMO_TRACE"
+TRACE_OWNER_ENV = "UKMO_TRACE_OWNER"
+PIPELINE_TRACE = os.environ.get(TRACE_ENV)
+
+# Spans are appended to this process' part file in batches
+TRACE_BATCH = 4096
+
+trace_lock = threading.Lock()
+trace_spans = []
+trace_threads = {}
+trace_pid = None
+
+
+def parts_dir():
+    return Path(f"{PIPELINE_TRACE}.parts")
+
+
+def now_us():
+    # Wall clock, comparable between processes (and roughly between nodes)
+    return time.time_ns() // 1000
+
+
+def init_trace():
+    # The process the user started owns the trace and merges every process' part when it exits,
+    # the processes it starts inherit the owner through the environment
+    if PIPELINE_TRACE and TRACE_OWNER_ENV not in os.environ:
+        os.environ[TRACE_OWNER_ENV] = str(os.getpid())
+        shutil.rmtree(parts_dir(), ignore_errors=True)
+        parts_dir().mkdir(parents=True)
+        atexit.register(merge_trace)
+
+
+def start_process():
+    # First span in a process, called with trace_lock held. A fork inherits the parent's buffer so it is dropped here
+    global trace_pid, trace_spans
+
+    trace_pid = os.getpid()
+    trace_spans = []
+    trace_threads.clear()
+
+    # Pool and spawn workers leave through multiprocessing's exit handlers, not atexit
+    atexit.register(flush_spans)
+    multiprocessing.util.Finalize(None, flush_spans, exitpriority=10)
+
+    name = multiprocessing.current_process().name
+    if name == 'MainProcess':
+        name = Path(sys.argv[0]).name
+    process = {'name': f"{name} ({trace_pid})"}
+    trace_spans.append({'name': 'process_name', 'ph': 'M', 'pid': trace_pid, 'tid': 0, 'args': process})
+
+
+def reset_lock():
+    # A fork can happen while another thread holds the lock, the child gets a fresh one
+    global trace_lock
+    trace_lock = threading.Lock()
+
+
+def record_span(event):
+    with trace_lock:
+        trace_spans.append(event)
+        full = len(trace_spans) >= TRACE_BATCH
+
+    if full:
+        flush_spans()
+
+
+def flush_spans():
+    global trace_spans
+
+    with trace_lock:
+        spans, trace_spans = trace_spans, []
+
+    if spans and trace_pid == os.getpid():
+        with open(parts_dir() / f"{trace_pid}.jsonl", 'a') as f:
+            f.write("".join(json.dumps(span) + "\n" for span in spans))
+
+
+def merge_trace():
+    if os.environ.get(TRACE_OWNER_ENV) != str(os.getpid()):
+        return
+    flush_spans()
+
+    events = []
+    for part in sorted(parts_dir().glob("*.jsonl")):
+        with open(part, 'r') as f:
+            events.extend(json.loads(line) for line in f)
+        part.unlink()
+    parts_dir().rmdir()
+
+    with open(PIPELINE_TRACE, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+    print_log(f"Saved pipeline trace with {len(events)} events to {PIPELINE_TRACE}", Fore.GREEN)
+
+
+@contextmanager
+def span(name, **args):
+    if PIPELINE_TRACE is None:
+        yield
+        return
+
+    # Threads can take their first span at the same time, process and thread setup happen under the lock
+    tid = threading.get_native_id()
+    with trace_lock:
+        if trace_pid != os.getpid():
+            start_process()
+
+        if tid not in trace_threads:
+            trace_threads[tid] = threading.current_thread().name
+            thread = {'name': trace_threads[tid]}
+            trace_spans.append({'name': 'thread_name', 'ph': 'M', 'pid': trace_pid, 'tid': tid, 'args': thread})
+        pid = trace_pid
+
+    start = now_us()
+    try:
+        yield
+    finally:
+        record_span({'name': name, 'ph': 'X', 'ts': start, 'dur': now_us() - start, 'pid': pid, 'tid': tid, 'args': args})
+
+
+def traced(func):
+    # Decorated functions are left untouched unless tracing is on
+    if PIPELINE_TRACE is None:
+        return func
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with span(func.__name__):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+init_trace()
+os.register_at_fork(after_in_child=reset_lock)
@@ -1,7 +1,13 @@
+import os
 import sys
+import json
+import time
+import queue
 import threading
 import multiprocessing
 from pathlib import Path
+from collections import deque
+from contextlib import contextmanager
 from colorama import init, Fore, Style
 from datetime import datetime, timedelta
 
@@ -11,7 +17,13 @@ from common.config import *
 init(autoreset=True)
 
 print_lock_t = threading.Lock()
-print_lock_p = multiprocessing.Lock()
+
+# Events are written in batches of up to EVENT_BATCH, or every EVENT_FLUSH seconds
+EVENT_BATCH = 256
+EVENT_FLUSH = 0.5
+
+# Set in the process running an event sink and in its workers, None otherwise
+event_queue = None
 
 
 def parse_run_time(time_str):
@@ -28,8 +40,136 @@ def print_log_t(message, color=Fore.BLUE):
 
 
 def print_log_p(message, color=Fore.BLUE):
-    with print_lock_p:
-        print(f"{color}{message}{Style.RESET_ALL}")
+    # From a pool worker: goes through the event sink when one is running, no lock in the worker
+    if event_queue is None:
+        print_log_t(message, color)
+    else:
+        log_event('log', message=message, color=color)
+
+
+def log_event(stage, run_id=None, duration=None, nbytes=None, outcome='ok', message=None, color=Fore.BLUE):
+    event = {
+        'time': time.time(),
+        'pid': os.getpid(),
+        'stage': stage,
+        'run_id': run_id,
+        'duration': duration,
+        'bytes': nbytes,
+        'outcome': outcome,
+        'message': message,
+        'color': color,
+    }
+
+    if event_queue is None:
+        if message:
+            print_log_t(message, color)
+    else:
+        event_queue.put(event)
+
+
+def init_events(events_queue):
+    # Pool initializer, workers enqueue to the parent's sink
+    global event_queue
+    event_queue = events_queue
+
+
+class EventSink:
+
+    def __init__(self, events_file, context=None):
+        self.events_file = events_file
+        self.queue = (context or multiprocessing).Queue()
+        self.stats = {}
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.listen, daemon=True)
+
+    def start(self):
+        Path(self.events_file).parent.mkdir(parents=True, exist_ok=True)
+        self.thread.start()
+
+    def stop(self):
+        # No sentinel through the queue: a worker killed mid-put can leave its write lock held
+        self.stopping.set()
+        self.thread.join()
+
+    def next_batch(self):
+        batch = []
+        deadline = time.monotonic() + EVENT_FLUSH
+
+        while len(batch) < EVENT_BATCH:
+            try:
+                batch.append(self.queue.get(timeout=max(0, deadline - time.monotonic())))
+            except queue.Empty:
+                break
+        return batch
+
+    def listen(self):
+        with open(self.events_file, 'a') as f:
+            while True:
+                batch = self.next_batch()
+
+                lines = []
+                messages = []
+                for event in batch:
+                    color = event.pop('color')
+                    if event['message']:
+                        messages.append(f"{color}{event['message']}{Style.RESET_ALL}")
+                    if event['stage'] != 'log':
+                        self.count(event)
+                        lines.append(json.dumps(event))
+
+                # One write and one print per batch
+                if lines:
+                    f.write("\n".join(lines) + "\n")
+                    f.flush()
+                if messages:
+                    with print_lock_t:
+                        print("\n".join(messages))
+
+                # Events still in the feeder threads of finished workers arrive within a flush interval
+                if not batch and self.stopping.is_set():
+                    return
+
+    def count(self, event):
+        stats = self.stats.setdefault(event['stage'], {'events': 0, 'failed': 0, 'duration': 0, 'bytes': 0})
+        stats['events'] += 1
+        stats['failed'] += event['outcome'] != 'ok'
+        stats['duration'] += event['duration'] or 0
+        stats['bytes'] += event['bytes'] or 0
+        stats['first'] = min(stats.get('first', event['time']), event['time'] - (event['duration'] or 0))
+        stats['last'] = max(stats.get('last', event['time']), event['time'])
+
+    def summary(self):
+        if not self.stats:
+            return
+
+        print_log(f"\nStage throughput (events in {self.events_file}):", Fore.YELLOW)
+        print_log(f"{'Stage':<12} {'Events':>7} {'Failed':>7} {'Mean s':>8} {'MB':>9} {'MB/s':>8} {'Events/s':>9}",
+                  Fore.MAGENTA)
+
+        for stage, stats in self.stats.items():
+            # Rates over wall time, events from parallel workers overlap
+            wall = max(stats['last'] - stats['first'], 1e-9)
+            print_log(
+                f"{stage:<12} {stats['events']:>7} {stats['failed']:>7} {stats['duration'] / stats['events']:>8.3f} "
+                f"{stats['bytes'] / 1e6:>9.1f} {stats['bytes'] / 1e6 / wall:>8.2f} {stats['events'] / wall:>9.1f}", Fore.CYAN)
+
+
+@contextmanager
+def event_sink(events_file, context=None):
+    # Runs the listener in this process, yields the queue to hand to pool workers through init_events.
+    # Pools must be closed and joined, not terminated, so workers flush their queued events. A spawn pool
+    # needs the sink created in the same context.
+    global event_queue
+    sink = EventSink(events_file, context)
+    sink.start()
+    event_queue = sink.queue
+
+    try:
+        yield sink.queue
+    finally:
+        event_queue = None
+        sink.stop()
+        sink.summary()
 
 
 def generate_runs():
@@ -42,3 +182,16 @@ def generate_runs():
             runs.append(timestamp.strftime("%Y%m%dT%H00Z"))
         current_date += timedelta(days=1)
     return runs
+
+
+def imap_bounded(pool, func, items, window):
+    # Like pool.imap but never more than `window` results waiting, keeps memory flat on slow consumers
+    pending = deque()
+
+    for item in items:
+        pending.append(pool.apply_async(func, (item, )))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+
+    while pending:
+        yield pending.popleft().get()
@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 
 import sys
-import pandas as pd
+import argparse
 from pathlib import Path
 from colorama import Fore
 
@@ -11,6 +11,8 @@ from common.utility import *
 
 
 def check_value(file_path):
+    import pandas as pd
+
     found_issues = False
 
     df = pd.read_csv(file_path)
@@ -27,6 +29,9 @@ def check_value(file_path):
 
 
 def main():
+    parser = argparse.ArgumentParser(description=f"List runs with missing values in {IGNORE_FILE}")
+    parser.parse_args()
+
     runs = generate_runs()
     print_log(f"Generated {len(runs)} runs", Fore.GREEN)
 
@@ -1,8 +1,7 @@
 #!/usr/bin/env python3
 
 import sys
-import pyproj
-import xarray as xr
+import argparse
 from pathlib import Path
 from colorama import Fore
 
@@ -12,6 +11,8 @@ from common.utility import *
 
 
 def extract_grid_info(ds, crs, x_idx, y_idx, station_lat, station_lon):
+    import pyproj
+
     grid_x = float(ds.projection_x_coordinate.values[x_idx])
     grid_y = float(ds.projection_y_coordinate.values[y_idx])
 
@@ -55,6 +56,9 @@ def print_metadata(ds):
 
 
 def open_and_find_grid(nc_file):
+    import pyproj
+    import xarray as xr
+
     station_lat, station_lon = STATIONS_LAT, STATIONS_LONG
 
     ds = xr.open_dataset(nc_file, decode_times=True, decode_timedelta=True)
@@ -71,14 +75,12 @@ def open_and_find_grid(nc_file):
 
 
 def main():
-    prog_name = Path(sys.argv[0]).name
-
-    if len(sys.argv) != 2:
-        print_log(f"Usage: {prog_name} <nc_file>", Fore.RED)
-        sys.exit(1)
+    parser = argparse.ArgumentParser(description="Show the grid point nearest the station and the file's metadata")
+    parser.add_argument('nc_file')
+    args = parser.parse_args()
 
     try:
-        nc_file = sys.argv[1]
+        nc_file = args.nc_file
 
         if not Path(nc_file).exists():
             print_log(f"File not found: {nc_file}", Fore.RED)
@@ -1,6 +1,7 @@
 import os
 import csv
 import sys
+import argparse
 from pathlib import Path
 
 sys.path.append(str(Path(__file__).parent.parent))
@@ -115,4 +116,5 @@ def process_files():
 
 
 if __name__ == '__main__':
+    argparse.ArgumentParser(description="Fill missing values in each run's CSV from the previous run").parse_args()
     process_files()
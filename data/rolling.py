@@ -2,6 +2,7 @@ import os
 import csv
 import shutil
 import sys
+import argparse
 from pathlib import Path
 
 sys.path.append(str(Path(__file__).parent.parent))
@@ -107,4 +108,5 @@ def process_files():
 
 
 if __name__ == '__main__':
+    argparse.ArgumentParser(description="Merge 12h and 24h runs into rolling CSVs").parse_args()
     process_files()
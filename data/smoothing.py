@@ -1,6 +1,4 @@
 import numpy as np
-from scipy.ndimage import gaussian_filter1d
-import matplotlib.pyplot as plt
 from datetime import datetime
 import csv
 
@@ -178,6 +176,8 @@ def plot_smoothed_data(times, results, title="Temperature Smoothing"):
     """
     Visualize original and smoothed data
     """
+    import matplotlib.pyplot as plt
+
     plt.figure(figsize=(14, 8))
     
     # Plot each dataset
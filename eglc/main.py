@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 
 import sys
-import requests
+import argparse
 from pathlib import Path
 from colorama import Fore
 from datetime import timedelta
@@ -43,6 +43,8 @@ def build_url():
 
 
 def download(url, path):
+    import requests
+
     try:
         response = requests.get(url)
         response.raise_for_status()
@@ -55,6 +57,9 @@ def download(url, path):
 
 
 def main():
+    parser = argparse.ArgumentParser(description=f"Download {STATION} METAR reports to {METAR_FILE}")
+    parser.parse_args()
+
     url = build_url()
 
     if download(url, METAR_FILE):
@@ -1,15 +1,13 @@
 import sys
-import boto3
 import concurrent.futures
 from pathlib import Path
 from datetime import timedelta
 from colorama import Fore
-from botocore import UNSIGNED
-from botocore.config import Config
 
 sys.path.append(str(Path(__file__).parent.parent))
 from common.config import *
 from common.utility import *
+from common.tracing import *
 
 DOWNLOAD_THREADS = 12
 
@@ -19,6 +17,10 @@ BUCKET_REGION = "eu-west-2"
 
 
 def create_s3_client():
+    import boto3
+    from botocore import UNSIGNED
+    from botocore.config import Config
+
     s3_config = Config(signature_version=UNSIGNED, region_name=BUCKET_REGION)
     return boto3.client('s3', config=s3_config)
 
@@ -73,6 +75,7 @@ def filter_download_files(run_id, s3_objects):
     return files
 
 
+@traced
 def download_file(args):
     key, file_path, filename, bucket, s3_client = args
 
@@ -114,6 +117,7 @@ def download_parallel(files, s3_client):
     return downloaded, files_downloaded, failed
 
 
+@traced
 def download_run_data(run_id):
     s3_client = create_s3_client()
 
@@ -1,7 +1,5 @@
 import csv
 import sys
-import pyproj
-import xarray as xr
 from pathlib import Path
 from datetime import timedelta
 from colorama import Fore
@@ -9,6 +7,7 @@ from colorama import Fore
 sys.path.append(str(Path(__file__).parent.parent))
 from common.config import *
 from common.utility import *
+from common.tracing import *
 
 
 def create_rows(run_id):
@@ -26,7 +25,12 @@ def create_rows(run_id):
     return rows
 
 
+@traced
 def extract_value(nc_file_path):
+    # Loaded on the first extraction, a worker still downloading does not pay for them
+    import pyproj
+    import xarray as xr
+
     try:
         ds = xr.open_dataset(nc_file_path, decode_timedelta=False)
 
@@ -85,6 +89,7 @@ def update_rows(rows, run_id, files):
     return rows
 
 
+@traced
 def write_csv_file(rows, run_id):
     csv_path = Path(CSV_DIR)
     csv_path.mkdir(parents=True, exist_ok=True)
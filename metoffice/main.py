@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
 
 import sys
+import time
 import shutil
+import argparse
 import multiprocessing
 from pathlib import Path
 from colorama import Fore
@@ -9,11 +11,18 @@ from colorama import Fore
 sys.path.append(str(Path(__file__).parent.parent))
 from common.config import *
 from common.utility import *
+from common.resources import *
+from common.tracing import *
 from download import download_run_data
 from extract import extract_run_data
 
 CONCURRENT_RUNS = 6
 
+# Peak RSS of one run's process: xarray, netCDF4 and pyproj plus one open field
+RUN_MEMORY = 2**30
+
+EVENTS_FILE = f"{DOWNLOAD_DIR}/metoffice_events.jsonl"
+
 
 def cleanup_run_files(run_id):
     run_dir = Path(NCDF_DIR) / run_id
@@ -22,33 +31,54 @@ def cleanup_run_files(run_id):
         shutil.rmtree(run_dir)
 
 
+def run_bytes(run_id, files):
+    run_dir = Path(NCDF_DIR) / run_id
+    return sum((run_dir / filename).stat().st_size for filename in files if (run_dir / filename).exists())
+
+
+@traced
 def process_single_run(run_id):
     print_log_p(f"Processing: {run_id}", Fore.BLUE)
+    start = time.perf_counter()
 
     try:
         download_success, files = download_run_data(run_id)
+        download_time = time.perf_counter() - start
+        log_event('download', run_id, download_time, run_bytes(run_id, files), 'ok' if download_success else 'failed')
 
         if not download_success:
             print_log_p(f"Download failed for {run_id}", Fore.RED)
+            log_event('run', run_id, time.perf_counter() - start, outcome='failed')
             return False
 
+        extract_start = time.perf_counter()
         extract_success, total_rows = extract_run_data(run_id, files)
 
+        csv_file = Path(CSV_DIR) / f"{run_id}.csv"
+        csv_bytes = csv_file.stat().st_size if extract_success else None
+        log_event('extract', run_id, time.perf_counter() - extract_start, csv_bytes, 'ok' if extract_success else 'failed')
+
         if not extract_success:
             print_log_p(f"Extraction failed for {run_id}", Fore.RED)
+            log_event('run', run_id, time.perf_counter() - start, outcome='failed')
             cleanup_run_files(run_id)
             return False
 
         cleanup_run_files(run_id)
+        log_event('run', run_id, time.perf_counter() - start)
         return True
 
     except Exception as e:
         print_log_p(f"Error processing {run_id}: {str(e)}", Fore.RED)
+        log_event('run', run_id, time.perf_counter() - start, outcome='error')
         cleanup_run_files(run_id)
         return False
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Download Met Office runs and extract the station's values to CSV")
+    parser.parse_args()
+
     print_log_p("Starting run-by-run weather data processing", Fore.BLUE)
 
     runs = generate_runs()
@@ -58,8 +88,17 @@ def main():
                 Fore.BLUE)
     print
 
-    with multiprocessing.Pool(processes=CONCURRENT_RUNS) as pool:
-        results = pool.map(process_single_run, runs)
+    # Downloads are I/O bound threads, extraction is what needs a core per process
+    processes, _ = plan_workers(CONCURRENT_RUNS, worker_memory=RUN_MEMORY)
+    print_plan("Processing runs", processes, 1)
+    set_thread_env(1)
+
+    # Workers enqueue messages and per-stage events, one listener here prints and writes them
+    with event_sink(EVENTS_FILE) as events:
+        with multiprocessing.Pool(processes=processes, initializer=init_events, initargs=(events, )) as pool:
+            results = pool.map(process_single_run, runs)
+            pool.close()
+            pool.join()
 
     success_runs = sum(results)
     failed_runs = total_runs - success_runs
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+
+import sys
+import csv
+import time
+import argparse
+import torch
+import numpy as np
+import torch.multiprocessing as mp
+from pathlib import Path
+from colorama import Fore
+from sklearn.metrics import mean_absolute_error, r2_score
+
+sys.path.append(str(Path(__file__).parent.parent))
+from common.config import *
+from common.utility import *
+from model.support import *
+from model.transformer import *
+from model.store import FCST_STEPS
+from model.transform import FORECAST_FRAME
+from model.main import prepare_data
+
+BACKTEST_FILE = f"{DOWNLOAD_DIR}/backtest.csv"
+
+# Runs overlap their neighbours by up to a full forecast frame of observations, training data stops
+# this long before the data it is scored on
+EMBARGO_HOURS = FORECAST_FRAME
+VALIDATION_FRACTION = 0.1
+
+SEASON_MONTHS = {'DJF': (12, 1, 2), 'MAM': (3, 4, 5), 'JJA': (6, 7, 8), 'SON': (9, 10, 11)}
+SEASONS = {month: season for season, months in SEASON_MONTHS.items() for month in months}
+
+BACKTEST_COLUMNS = ['fold', 'test_start', 'test_end', 'train_runs', 'test_runs', 'epochs', 'val_loss', 'mae', 'r2', 'minutes']
+
+
+def run_times(run_ids):
+    return np.array([parse_run_time(run) for run in run_ids], dtype='datetime64[m]')
+
+
+def before(times, indices, cutoff):
+    # Indices whose run is at least EMBARGO_HOURS older than cutoff
+    return indices[times[indices] < cutoff - np.timedelta64(EMBARGO_HOURS, 'h')]
+
+
+def make_folds(run_ids, folds, test_days):
+    # Rolling origin: the last `folds` blocks of `test_days` are each scored by a model trained on everything before them
+    times = run_times(run_ids)
+    order = np.argsort(times, kind='stable')
+    end = times.max().astype('datetime64[D]') + np.timedelta64(1, 'D')
+
+    fold_list = []
+    for fold in range(folds):
+        test_end = end - np.timedelta64((folds - 1 - fold) * test_days, 'D')
+        test_start = test_end - np.timedelta64(test_days, 'D')
+        test_data = order[(times[order] >= test_start) & (times[order] < test_end)]
+
+        # Early stopping uses the most recent part of the training window, embargoed like the test block
+        history = before(times, order, test_start)
+        if len(history) == 0 or len(test_data) == 0:
+            continue
+
+        val_start = times[history[-max(1, int(len(history) * VALIDATION_FRACTION))]]
+        train_data = before(times, history, val_start)
+        val_data = history[times[history] >= val_start]
+
+        if len(train_data) == 0:
+            continue
+
+        fold_list.append({
+            'fold': fold,
+            'test_start': str(test_start),
+            'test_end': str(test_end),
+            'train': train_data,
+            'val': val_data,
+            'test': test_data,
+        })
+
+    return fold_list
+
+
+def init_backtest_worker(data, sizes, settings):
+    global backtest_data, backtest_sizes, backtest_settings
+    backtest_data, backtest_sizes, backtest_settings = data, sizes, settings
+
+    configure_cpu_threads(settings['threads'])
+
+
+def fold_dataset(indices, shuffle):
+    index = torch.from_numpy(indices)
+    return create_dataset(tuple(tensor.index_select(0, index) for tensor in backtest_data), shuffle=shuffle)
+
+
+def run_fold(fold):
+    torch.manual_seed(backtest_settings['seed'])
+    print_log_p(f"Fold {fold['fold']}: {len(fold['train'])} train runs, testing {fold['test_start']} - {fold['test_end']}",
+                Fore.YELLOW)
+
+    model = build_model(backtest_sizes)
+    params = {**TRAIN_PARAMS, 'epochs': backtest_settings['epochs'], 'model_file': None}
+
+    start = time.perf_counter()
+    result = train_model(model, fold_dataset(fold['train'], True), fold_dataset(fold['val'], False), params)
+
+    preds, targets = eval_model(model, fold_dataset(fold['test'], False))
+    return {
+        **fold,
+        'val_loss': result['val_loss'],
+        'epochs': result['epochs'],
+        'preds': preds.reshape(-1, FCST_STEPS),
+        'targets': targets.reshape(-1, FCST_STEPS),
+        'minutes': (time.perf_counter() - start) / 60,
+    }
+
+
+def write_results(results):
+    Path(BACKTEST_FILE).parent.mkdir(parents=True, exist_ok=True)
+
+    with open(BACKTEST_FILE, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(BACKTEST_COLUMNS)
+
+        for result in sorted(results, key=lambda result: result['fold']):
+            mae = mean_absolute_error(result['targets'].ravel(), result['preds'].ravel())
+            r2 = r2_score(result['targets'].ravel(), result['preds'].ravel())
+            writer.writerow([
+                result['fold'], result['test_start'], result['test_end'],
+                len(result['train']),
+                len(result['test']), result['epochs'], result['val_loss'], mae, r2, result['minutes']
+            ])
+
+
+def report_backtest(results, run_ids):
+    results = sorted(results, key=lambda result: result['fold'])
+
+    print_log("\nBacktest folds:", Fore.YELLOW)
+    print_log(f"{'Fold':>4} {'Test start':<17} {'Train':>6} {'Test':>5} {'Epochs':>6} {'MAE':>8} {'R²':>8}", Fore.MAGENTA)
+    for result in results:
+        mae = mean_absolute_error(result['targets'].ravel(), result['preds'].ravel())
+        r2 = r2_score(result['targets'].ravel(), result['preds'].ravel())
+        print_log(
+            f"{result['fold']:>4} {result['test_start']:<17} {len(result['train']):>6} {len(result['test']):>5} "
+            f"{result['epochs']:>6} {mae:>8.4f} {r2:>8.4f}", Fore.GREEN)
+
+    errors = np.abs(np.concatenate([result['preds'] - result['targets'] for result in results]))
+    test_times = run_times(run_ids)[np.concatenate([result['test'] for result in results])].astype(object)
+    seasons = np.array([SEASONS[dt.month] for dt in test_times])
+
+    print_log("\nMAE per lead hour (all folds):", Fore.YELLOW)
+    print_log(f"{'Lead':>4} {'MAE':>8}", Fore.MAGENTA)
+    for step in range(FCST_STEPS):
+        print_log(f"{step + 1:>4} {errors[:, step].mean():>8.4f}", Fore.GREEN)
+
+    print_log("\nMAE per season (all folds):", Fore.YELLOW)
+    print_log(f"{'Season':<6} {'Runs':>6} {'MAE':>8}", Fore.MAGENTA)
+    for season in ['DJF', 'MAM', 'JJA', 'SON']:
+        mask = seasons == season
+        if mask.any():
+            print_log(f"{season:<6} {mask.sum():>6} {errors[mask].mean():>8.4f}", Fore.GREEN)
+
+    print_log(f"\nOverall MAE: {errors.mean():.4f} over {len(errors)} test runs", Fore.CYAN)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Walk-forward backtest over time-ordered folds")
+    parser.add_argument('--folds', type=int, default=4)
+    parser.add_argument('--test-days', type=int, default=30, help="length of each test block")
+    parser.add_argument('--epochs', type=int, default=TRAIN_PARAMS['epochs'])
+    parser.add_argument('--workers',
+                        type=int,
+                        default=None,
+                        help="folds trained in parallel (default: one per fold, at most cores)")
+    parser.add_argument('--threads', type=int, default=None, help="CPU threads per fold (default: cores / workers)")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    features = prepare_data(generate_runs())
+    folds = make_folds(features['run_id'], args.folds, args.test_days)
+    if not folds:
+        print_log("Error: not enough runs for a single fold", Fore.RED)
+        sys.exit(1)
+
+    workers, threads = plan_workers(args.workers or len(folds), args.threads, TRAIN_MEMORY)
+    print_plan("Backtest", workers, threads)
+
+    # Cached features are loaded once, every fold process maps the same shared memory
+    data = prep_datasets(features, np.arange(len(features['run_id'])))
+    for tensor in data:
+        tensor.share_memory_()
+
+    settings = {'epochs': args.epochs, 'threads': threads, 'seed': args.seed}
+    print_log(f"Running {len(folds)} folds on {workers} workers with {threads} threads each", Fore.CYAN)
+
+    # Spawned folds size their BLAS/OpenMP pools from the environment at start-up
+    set_thread_env(threads)
+
+    results = []
+    context = mp.get_context('spawn')
+    initargs = (data, feature_sizes(features), settings)
+
+    with context.Pool(processes=workers, initializer=init_backtest_worker, initargs=initargs) as pool:
+        for result in pool.imap_unordered(run_fold, folds):
+            results.append(result)
+            write_results(results)
+            print_log_p(f"Fold {result['fold']} finished in {result['minutes']:.1f} min", Fore.GREEN)
+
+    report_backtest(results, features['run_id'])
+    print_log(f"Saved fold results to {BACKTEST_FILE}", Fore.GREEN)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+
+import sys
+import copy
+import json
+import time
+import threading
+import subprocess
+import argparse
+import urllib.request
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import numpy as np
+from pathlib import Path
+from colorama import Fore
+
+sys.path.append(str(Path(__file__).parent.parent))
+from common.config import *
+from common.utility import *
+from model.support import *
+from model.store import FEATURE_SHAPES
+from model.transformer import build_model
+from model.export import ENGINE_FILE
+from model.runtime import InferenceEngine, INPUT_FIELDS
+from model.serve import create_server
+from model.distributed import init_distributed, launch_local, wrap_ddp
+
+# Entry points started with --help, which parses arguments and exits before doing any work
+STARTUP_ENTRY_POINTS = [
+    'model/main.py', 'eglc/main.py', 'metoffice/main.py', 'data/csv_check.py', 'data/netcdf.py', 'data/patch.py',
+    'data/rolling.py'
+]
+STARTUP_BUDGET = 0.5
+STARTUP_RUNS = 5
+
+
+def time_call(func, repeat):
+    # Warm-up call keeps allocator and lazy init out of the measurement
+    func()
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat
+
+
+def synthetic_sizes():
+    return feature_sizes({name: np.empty((1, *shape)) for name, shape in FEATURE_SHAPES.items()})
+
+
+def synthetic_batch(batch_size, device):
+    return tuple(torch.randn((batch_size, *FEATURE_SHAPES[name]), device=device) for name in DATASET_FIELDS)
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def smooth_round_reference(x, k):
+    # Unfused loop TemperatureDecoder used before SmoothRound
+    result = torch.zeros_like(x)
+    x_floor = torch.floor(x)
+
+    for offset in range(-2, 3):
+        n = x_floor + offset
+        sig_left = 1 / (1 + torch.exp(-(k * (x - (n - 0.5)))))
+        sig_right = 1 / (1 + torch.exp(-(k * (x - (n + 0.5)))))
+        result += n * (sig_left - sig_right)
+
+    return result
+
+
+def bench_smooth(args):
+    torch.manual_seed(0)
+
+    print_log("Smooth rounding: fused vs reference", Fore.YELLOW)
+
+    x = torch.randn(4096, 14, dtype=torch.float64) * 10
+    for k in [5, 15, 20]:
+        x_fused = x.clone().requires_grad_()
+        x_ref = x.clone().requires_grad_()
+
+        fused = SmoothRound.apply(x_fused, k)
+        ref = smooth_round_reference(x_ref, k)
+        fused.sum().backward()
+        ref.sum().backward()
+
+        forward_diff = (fused - ref).abs().max().item()
+        backward_diff = (x_fused.grad - x_ref.grad).abs().max().item()
+        print_log(f"  k={k:<3} max |forward diff|: {forward_diff:.2e}, max |grad diff|: {backward_diff:.2e}", Fore.CYAN)
+
+    x_check = (torch.randn(64, 14, dtype=torch.float64) * 10).requires_grad_()
+    gradcheck = torch.autograd.gradcheck(lambda x: SmoothRound.apply(x, 15.0), (x_check, ))
+    print_log(f"  gradcheck: {'passed' if gradcheck else 'failed'}", Fore.GREEN if gradcheck else Fore.RED)
+
+    print_log(f"{'Batch':>8} {'Reference ms':>14} {'Fused ms':>10} {'Speedup':>8}", Fore.MAGENTA)
+    for batch_size in [128, 1024, 8192]:
+        x = (torch.randn(batch_size, 14) * 10).requires_grad_()
+
+        def run_reference():
+            smooth_round_reference(x, 15.0).sum().backward()
+
+        def run_fused():
+            SmoothRound.apply(x, 15.0).sum().backward()
+
+        ref_time = time_call(run_reference, args.repeat)
+        fused_time = time_call(run_fused, args.repeat)
+        print_log(f"{batch_size:>8} {ref_time * 1e3:>14.3f} {fused_time * 1e3:>10.3f} {ref_time / fused_time:>7.2f}x",
+                  Fore.GREEN)
+
+
+def model_step(model, batch, device, train):
+    t_run_hour, t_input, t_time, t_temp = batch
+
+    if not train:
+        with torch.no_grad(), autocast(device):
+            model(t_run_hour, t_input, t_time)
+        synchronize(device)
+        return
+
+    with autocast(device):
+        loss = nn.functional.mse_loss(model(t_run_hour, t_input, t_time), t_temp)
+    loss.backward()
+    model.zero_grad(set_to_none=True)
+    synchronize(device)
+
+
+def bench_compile(args):
+    torch.manual_seed(0)
+    device = select_device(args.device)
+
+    eager_model = build_model(synthetic_sizes()).to(device)
+    eager_model.train(args.train)
+
+    compiled_model = copy.deepcopy(eager_model)
+    compile_model(compiled_model)
+
+    mode = "training step" if args.train else "inference"
+    print_log(f"Eager vs compiled {mode}", Fore.YELLOW)
+    print_log(f"{'Batch':>8} {'Compile s':>10} {'Eager/s':>10} {'Compiled/s':>11} {'Speedup':>8}", Fore.MAGENTA)
+
+    for batch_size in args.batch_sizes:
+        batch = synthetic_batch(batch_size, device)
+
+        # First compiled call at a new batch size includes (re)compilation
+        compile_start = time.perf_counter()
+        model_step(compiled_model, batch, device, args.train)
+        compile_time = time.perf_counter() - compile_start
+
+        eager_time = time_call(lambda: model_step(eager_model, batch, device, args.train), args.repeat)
+        compiled_time = time_call(lambda: model_step(compiled_model, batch, device, args.train), args.repeat)
+
+        print_log(
+            f"{batch_size:>8} {compile_time:>10.2f} {batch_size / eager_time:>10.0f} {batch_size / compiled_time:>11.0f} "
+            f"{eager_time / compiled_time:>7.2f}x", Fore.GREEN)
+
+
+def bench_engine(args):
+    if not Path(ENGINE_FILE).exists():
+        print_log(f"Error: engine not found: {ENGINE_FILE}, run 'python model/main.py export' first", Fore.RED)
+        sys.exit(1)
+
+    runtime = Path(__file__).parent / "runtime.py"
+
+    # Cold start: fresh interpreter, torch import, engine load and first prediction
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, str(runtime), ENGINE_FILE], capture_output=True, text=True, check=True)
+    cold_start = time.perf_counter() - start
+    timings = json.loads(result.stdout.strip().splitlines()[-1])
+
+    print_log("Inference engine on CPU", Fore.YELLOW)
+    print_log(
+        f"  Cold start: {cold_start:.2f} s (load {timings['load_s']:.2f} s, "
+        f"first batch {timings['first_predict_s'] * 1e3:.1f} ms)", Fore.CYAN)
+
+    engine = InferenceEngine(ENGINE_FILE, threads=args.threads)
+    schema = engine.meta['schema']
+
+    print_log(f"{'Batch':>8} {'p50 ms':>8} {'p99 ms':>8} {'Samples/s':>10}", Fore.MAGENTA)
+    for batch_size in args.batch_sizes:
+        batch = [np.random.randn(batch_size, *schema[name]).astype(np.float32) for name in INPUT_FIELDS]
+        engine.predict(*batch)
+
+        latencies = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            engine.predict(*batch)
+            latencies.append(time.perf_counter() - start)
+
+        p50, p99 = np.percentile(latencies, [50, 99])
+        print_log(f"{batch_size:>8} {p50 * 1e3:>8.2f} {p99 * 1e3:>8.2f} {batch_size / p50:>10.0f}", Fore.GREEN)
+
+
+def synthetic_rows(run):
+    run_dt = parse_run_time(run)
+    rows = []
+
+    for hour in range(FORECAST_HOURS):
+        dt = run_dt + timedelta(hours=hour)
+        row = {field: float(np.random.uniform(275, 295)) for field in COLUMN_PROCESS}
+        row['date'], row['hour'] = dt.strftime("%Y%m%d"), dt.strftime("%H%M")
+        rows.append(row)
+    return rows
+
+
+def post_json(url, payload):
+    request = urllib.request.Request(url, data=json.dumps(payload).encode(), headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
+
+
+def bench_serve(args):
+    device = select_device(args.device)
+    model = build_model(synthetic_sizes()).to(device).eval()
+
+    server = create_server(model, device, port=0)
+    url = f"http://{server.server_address[0]}:{server.server_address[1]}"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    payload = {'run': "20230701T0300Z", 'rows': synthetic_rows("20230701T0300Z")}
+
+    def client():
+        for _ in range(args.repeat):
+            post_json(f"{url}/predict", payload)
+
+    print_log("Prediction daemon, concurrent clients over HTTP", Fore.YELLOW)
+    print_log(f"{'Clients':>8} {'p50 ms':>8} {'p99 ms':>8} {'Mean batch':>11} {'Requests/s':>11}", Fore.MAGENTA)
+
+    for clients in args.batch_sizes:
+        # Fresh latency window per level, the handler class holds the batcher
+        batcher = server.RequestHandlerClass.batcher
+        batcher.latencies.clear()
+        batcher.batch_sizes.clear()
+
+        threads = [threading.Thread(target=client) for _ in range(clients)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        stats = batcher.stats()
+        print_log(
+            f"{clients:>8} {stats['p50_ms']:>8.2f} {stats['p99_ms']:>8.2f} {stats['mean_batch']:>11.2f} "
+            f"{stats['requests'] / elapsed:>11.0f}", Fore.GREEN)
+
+    server.shutdown()
+    server.server_close()
+
+
+def ddp_bench_worker(results, steps):
+    rank, _ = init_distributed()
+    world_size = dist.get_world_size()
+    device = torch.device('cpu')
+
+    model = wrap_ddp(build_model(synthetic_sizes()))
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-4)
+
+    # Global batch of BATCH_SIZE split across the processes, like train --procs
+    t_run_hour, t_input, t_time, t_temp = synthetic_batch(max(1, BATCH_SIZE // world_size), device)
+
+    def step():
+        optimizer.zero_grad()
+        with autocast(device):
+            loss = nn.functional.mse_loss(model(t_run_hour, t_input, t_time), t_temp)
+        loss.backward()
+        optimizer.step()
+
+    step()
+    dist.barrier()
+
+    start = time.perf_counter()
+    for _ in range(steps):
+        step()
+    dist.barrier()
+    elapsed = time.perf_counter() - start
+
+    if rank == 0:
+        results.put({'samples_per_sec': BATCH_SIZE * steps / elapsed, 'threads': torch.get_num_threads()})
+    dist.destroy_process_group()
+
+
+def bench_ddp(args):
+    results = mp.get_context('spawn').SimpleQueue()
+
+    print_log(f"Data-parallel training steps on CPU ({cpu_budget()} cores, global batch {BATCH_SIZE})", Fore.YELLOW)
+    print_log(f"{'Procs':>6} {'Threads':>8} {'Samples/s':>10} {'Speedup':>8} {'Efficiency':>11}", Fore.MAGENTA)
+
+    baseline = None
+    for procs in args.procs:
+        launch_local(ddp_bench_worker, procs, results, args.repeat)
+        result = results.get()
+
+        baseline = baseline or result['samples_per_sec']
+        speedup = result['samples_per_sec'] / baseline
+        print_log(
+            f"{procs:>6} {result['threads']:>8} {result['samples_per_sec']:>10.0f} {speedup:>7.2f}x "
+            f"{speedup / procs:>10.0%}", Fore.GREEN)
+
+
+def import_times(stderr):
+    # -X importtime lines are "import time: self | cumulative | package", nested imports are indented further
+    times = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+
+        _, cumulative, package = line[len('import time:'):].split('|')
+        if not package.startswith('  '):
+            times.append((package.strip(), int(cumulative) / 1e6))
+    return times
+
+
+def bench_startup(args):
+    root = Path(__file__).parent.parent
+    print_log(f"Start-up of every entry point with --help, best of {STARTUP_RUNS}, budget {args.budget:.2f} s", Fore.YELLOW)
+    print_log(f"{'Entry point':<20} {'Wall s':>7} {'Import s':>9}  {'Heaviest import':<28} {'Status':>6}", Fore.MAGENTA)
+
+    over = []
+    for entry in STARTUP_ENTRY_POINTS:
+        best = None
+        for _ in range(STARTUP_RUNS):
+            start = time.perf_counter()
+            result = subprocess.run([sys.executable, '-X', 'importtime', entry, '--help'],
+                                    cwd=root,
+                                    capture_output=True,
+                                    text=True)
+            wall = time.perf_counter() - start
+
+            if best is None or wall < best[0]:
+                best = (wall, import_times(result.stderr))
+
+        wall, times = best
+        name, heaviest = max(times, key=lambda item: item[1])
+        status = 'ok' if wall <= args.budget else 'over'
+        if wall > args.budget:
+            over.append(entry)
+
+        print_log(f"{entry:<20} {wall:>7.3f} {sum(t for _, t in times):>9.3f}  {f'{name} ({heaviest:.3f} s)':<28} {status:>6}",
+                  Fore.GREEN if status == 'ok' else Fore.RED)
+
+    if over:
+        print_log(f"Over the start-up budget: {', '.join(over)}", Fore.RED)
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Model micro-benchmarks")
+    parser.add_argument('bench', choices=['smooth', 'compile', 'engine', 'serve', 'ddp', 'startup'])
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--device', default=None, help="cpu, cuda or cuda:N (default: cuda:0 when available)")
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 32, 128, 512])
+    parser.add_argument('--train', action='store_true', help="benchmark training steps instead of inference")
+    parser.add_argument('--threads', type=int, default=None, help="CPU threads for the inference engine")
+    parser.add_argument('--procs', type=int, nargs='+', default=[1, 2, 4, 8], help="process counts for the ddp benchmark")
+    parser.add_argument('--budget', type=float, default=STARTUP_BUDGET, help="start-up budget in seconds per entry point")
+    args = parser.parse_args()
+
+    if args.bench == 'smooth':
+        bench_smooth(args)
+    elif args.bench == 'compile':
+        bench_compile(args)
+    elif args.bench == 'engine':
+        bench_engine(args)
+    elif args.bench == 'serve':
+        bench_serve(args)
+    elif args.bench == 'ddp':
+        bench_ddp(args)
+    elif args.bench == 'startup':
+        bench_startup(args)
+
+
+if __name__ == "__main__":
+    main()
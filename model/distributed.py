@@ -0,0 +1,145 @@
+import os
+import sys
+import socket
+import torch
+import numpy as np
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from pathlib import Path
+from colorama import Fore
+from datetime import timedelta
+from torch.nn.parallel import DistributedDataParallel
+
+sys.path.append(str(Path(__file__).parent.parent))
+from common.config import *
+from common.utility import *
+from model.support import *
+from model.transformer import *
+
+DDP_ADDR = "127.0.0.1"
+
+# Collectives wait this long, covers the first barrier while rank 0 builds a cold feature store
+DDP_TIMEOUT = timedelta(hours=2)
+
+
+def is_distributed_env():
+    # Set by torchrun for multi-node jobs, or by launch_local on one machine
+    return 'WORLD_SIZE' in os.environ
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind((DDP_ADDR, 0))
+        return s.getsockname()[1]
+
+
+def launch_local(worker, procs, *args):
+    master = (os.environ.get('MASTER_ADDR', DDP_ADDR), os.environ.get('MASTER_PORT') or str(free_port()))
+
+    # Ranks keep the world size they were asked for, the cores are split between them
+    threads = max(1, cpu_budget() // procs)
+    print_plan("Data-parallel training", procs, threads)
+    set_thread_env(threads)
+    mp.spawn(local_worker, args=(worker, procs, master, args), nprocs=procs)
+
+
+def local_worker(local_rank, worker, procs, master, args):
+    os.environ.update({
+        'MASTER_ADDR': master[0],
+        'MASTER_PORT': master[1],
+        'RANK': str(local_rank),
+        'WORLD_SIZE': str(procs),
+        'LOCAL_RANK': str(local_rank),
+        'LOCAL_WORLD_SIZE': str(procs),
+    })
+    worker(*args)
+
+
+def init_distributed():
+    rank = int(os.environ['RANK'])
+    local_world_size = int(os.environ['LOCAL_WORLD_SIZE'])
+
+    dist.init_process_group('gloo', rank=rank, world_size=int(os.environ['WORLD_SIZE']), timeout=DDP_TIMEOUT)
+
+    # Only rank 0 logs, the machine's cores are split between its processes
+    if rank != 0:
+        sys.stdout = open(os.devnull, 'w')
+    configure_cpu_threads(max(1, cpu_budget() // local_world_size))
+
+    return rank, int(os.environ['LOCAL_RANK'])
+
+
+def shard(indices, rank, world_size, drop_remainder=True):
+    # Equal shards so every rank runs the same number of training steps, the remainder is dropped.
+    # Evaluation has no collective per step, so its shards keep every sample.
+    if not drop_remainder:
+        return np.array_split(indices, world_size)[rank]
+
+    size = len(indices) // world_size
+    return indices[rank * size:(rank + 1) * size]
+
+
+def wrap_ddp(model):
+    # Buffers are constants or set identically on every rank by set_epoch, no need to sync them each forward
+    return DistributedDataParallel(model, forward_sync_buffers=False)
+
+
+def distributed_validate(model, dataloader, criterion):
+    # Same mean-of-batch-losses as validate_model, over every rank's shard, so all ranks take the same
+    # scheduler and early stopping decisions
+    total = torch.tensor([validate_model(model, dataloader, criterion) * len(dataloader), len(dataloader)], dtype=torch.float64)
+    dist.all_reduce(total)
+    return (total[0] / total[1]).item()
+
+
+def distributed_metrics(model, dataloader):
+    # Every rank accumulates its shard around the global target mean, so the sums add up across ranks
+    targets = dataloader.data_tensors[-1]
+    total = torch.tensor([targets.double().sum(), targets.numel()], dtype=torch.float64)
+    dist.all_reduce(total)
+
+    metrics = MetricsAccumulator(targets.size(1), shift=total[0] / total[1])
+    for preds, t_temp in eval_batches(model, dataloader):
+        metrics.update(preds, t_temp)
+
+    count = torch.tensor([metrics.count], dtype=torch.float64)
+    dist.all_reduce(metrics.sums)
+    dist.all_reduce(count)
+    metrics.count = int(count.item())
+    return metrics.metrics()
+
+
+def train_distributed(features, compiled=False, profile=(0, 0), resume=False):
+    rank, world_size = dist.get_rank(), dist.get_world_size()
+    train_data, eval_data = split_indices(features)
+
+    # Global batch stays BATCH_SIZE so the single-process hyperparameters carry over
+    train_dataset = BatchIterator(prep_datasets(features, shard(train_data, rank, world_size)),
+                                  batch_size=max(1, BATCH_SIZE // world_size),
+                                  shuffle=True)
+    eval_shard = shard(eval_data, rank, world_size, drop_remainder=False)
+    eval_dataset = create_dataset(prep_datasets(features, eval_shard), shuffle=False)
+    print_log(f"Training on {world_size} processes, {len(train_data) // world_size} train samples each", Fore.CYAN)
+
+    model = build_model(feature_sizes(features))
+    if compiled:
+        compile_model(model)
+
+    ddp_model = wrap_ddp(model)
+
+    params = {
+        **TRAIN_PARAMS,
+        'validate': distributed_validate,
+        'evaluate': distributed_metrics,
+        'profile': profile if rank == 0 else (0, 0),
+        'checkpoint': CHECKPOINT_FILE if rank == 0 else None,
+        'model_file': MODEL_FILE if rank == 0 else None,
+        'resume': CHECKPOINT_FILE if resume else None,
+        'optimizer_file': OPTIMIZER_FILE if rank == 0 else None,
+    }
+
+    print_log(f"Training Transformer model with params: {TRAIN_PARAMS}", Fore.YELLOW)
+    result = train_model(ddp_model, train_dataset, eval_dataset, params)
+
+    if rank == 0:
+        record_version(MODEL_FILE, 'train', features['run_id'], features['run_id'], result)
@@ -0,0 +1,74 @@
+import numpy as np
+
+MAX_WEEKS = 53
+MINUTES_PER_DAY = 24 * 60
+
+
+def cyclical_encode(value, max_value):
+    angle = 2 * np.pi * value / max_value
+    return np.sin(angle), np.cos(angle)
+
+
+def build_week_table():
+    # Indexed by [weeks_in_year, week], only the 52 and 53 week rows are ever used
+    table = np.zeros((MAX_WEEKS + 1, MAX_WEEKS + 1, 2))
+
+    for total_weeks in [52, 53]:
+        week = np.arange(MAX_WEEKS + 1)
+        table[total_weeks, :, 0], table[total_weeks, :, 1] = cyclical_encode(week, total_weeks)
+    return table
+
+
+def build_minute_table():
+    # Indexed by minute of the day
+    minute = np.arange(MINUTES_PER_DAY)
+    hour_decimal = minute // 60 + minute % 60 / 60
+    return np.stack(cyclical_encode(hour_decimal, 24), axis=-1)
+
+
+WEEK_TABLE = build_week_table()
+MINUTE_TABLE = build_minute_table()
+
+
+def days_since_epoch(years, months, days):
+    dates = (years - 1970).astype('datetime64[Y]') + (months - 1).astype('timedelta64[M]')
+    dates = dates.astype('datetime64[D]') + (days - 1).astype('timedelta64[D]')
+    return dates.astype(np.int64)
+
+
+def iso_week(days):
+    # Days since 1970-01-01 (a Thursday), ISO weeks are numbered by the year of their Thursday
+    weekday = (days + 3) % 7
+    thursday = days - weekday + 3
+    year_start = thursday.astype('datetime64[D]').astype('datetime64[Y]').astype('datetime64[D]').astype(np.int64)
+    return (thursday - year_start) // 7 + 1
+
+
+def weeks_in_year(years):
+    # Dec 28 is always in the last week of the year
+    return iso_week(days_since_epoch(years, np.full_like(years, 12), np.full_like(years, 28)))
+
+
+def date_to_week(date):
+    # date: YYYYMMDD as numbers
+    date = np.asarray(date).astype(np.int64)
+    years, months, days = date // 10000, date // 100 % 100, date % 100
+    return iso_week(days_since_epoch(years, months, days)), weeks_in_year(years)
+
+
+def hhmm_to_minute(hour):
+    # hour: HHMM as numbers
+    hour = np.asarray(hour).astype(np.int64)
+    return hour // 100 * 60 + hour % 100
+
+
+def datetime_to_minute(dt):
+    return dt.hour * 60 + dt.minute
+
+
+def encode_week(week, total_weeks):
+    return WEEK_TABLE[total_weeks, week]
+
+
+def encode_minute(minute):
+    return MINUTE_TABLE[minute]
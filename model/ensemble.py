@@ -0,0 +1,106 @@
+import sys
+import torch
+import numpy as np
+from pathlib import Path
+from colorama import Fore
+from datetime import timedelta
+
+sys.path.append(str(Path(__file__).parent.parent))
+from common.config import *
+from common.utility import *
+from model.transform import *
+from model.support import autocast
+from model.runtime import INPUT_FIELDS
+
+# Weight of a run halves every LEAD_HALF_LIFE hours of lead time
+LEAD_HALF_LIFE = 6
+
+
+def lead_weight(lead_hours):
+    return 0.5**(lead_hours / LEAD_HALF_LIFE)
+
+
+def covering_runs(start, end):
+    # Hourly runs with at least one forecast time inside [start, end]
+    runs = []
+    run_dt = (start - timedelta(hours=FORECAST_FRAME)).replace(minute=0, second=0, microsecond=0)
+
+    while run_dt <= end:
+        run = run_dt.strftime("%Y%m%dT%H00Z")
+        if any(start <= dt <= end for dt in forecast_times(run)):
+            runs.append(run)
+        run_dt += timedelta(hours=1)
+    return runs
+
+
+def predict_runs(model, device, runs, raws, amp=True):
+    # Every run in a single forward pass
+    times = [forecast_times(run) for run in runs]
+    features = transform_runs(runs, raws, times)
+
+    tensors = [torch.from_numpy(features[name].astype(np.float32)).to(device) for name in INPUT_FIELDS]
+    with torch.inference_mode(), autocast(device, enabled=amp):
+        temps = model(*tensors).float().cpu().numpy()
+
+    return times, temps
+
+
+def blend(runs, times, temps, start, end):
+    members = {}
+
+    for run, run_times, run_temps in zip(runs, times, temps):
+        run_dt = parse_run_time(run)
+
+        for dt, temp in zip(run_times, run_temps):
+            if start <= dt <= end:
+                lead = (dt - run_dt).total_seconds() / 3600
+                members.setdefault(dt, []).append({'run': run, 'lead': lead, 'temp': float(temp)})
+
+    blended = {}
+    for dt in sorted(members):
+        weights = np.array([lead_weight(member['lead']) for member in members[dt]])
+        values = np.array([member['temp'] for member in members[dt]])
+        blended[dt] = float((weights * values).sum() / weights.sum())
+
+    return members, blended
+
+
+def ensemble_forecast(model, device, runs, raws, start, end, amp=True):
+    # Per-run forecasts and the lead-time weighted blend for every forecast time in [start, end]
+    times, temps = predict_runs(model, device, runs, raws, amp)
+    members, blended = blend(runs, times, temps, start, end)
+
+    per_run = {run: dict(zip(run_times, run_temps.tolist())) for run, run_times, run_temps in zip(runs, times, temps)}
+    return {'runs': per_run, 'members': members, 'blend': blended}
+
+
+def latest_member(members):
+    return min(members, key=lambda member: member['lead'])
+
+
+def report_ensemble(forecast, observed):
+    print_log("Ensemble forecast:", Fore.YELLOW)
+    print_log(f"{'Time':<16} {'Runs':>5} {'Latest':>8} {'Mean':>8} {'Blend':>8} {'Observed':>9}", Fore.MAGENTA)
+    print_log("-" * 59, Fore.MAGENTA)
+
+    errors = {'latest': [], 'mean': [], 'blend': []}
+    for dt, blended in forecast['blend'].items():
+        members = forecast['members'][dt]
+        latest = latest_member(members)['temp']
+        mean = float(np.mean([member['temp'] for member in members]))
+
+        actual = observed.get(dt)
+        actual_str = f"{actual:>9.2f}" if actual is not None else f"{'-':>9}"
+        print_log(
+            f"{dt.strftime('%Y%m%dT%H%MZ'):<16} {len(members):>5} {latest:>8.2f} {mean:>8.2f} {blended:>8.2f} "
+            f"{actual_str}", Fore.GREEN)
+
+        if actual is not None:
+            errors['latest'].append(abs(latest - actual))
+            errors['mean'].append(abs(mean - actual))
+            errors['blend'].append(abs(blended - actual))
+
+    if errors['blend']:
+        print_log(f"\nMAE over {len(errors['blend'])} observed times:", Fore.YELLOW)
+        for name, error in errors.items():
+            print_log(f"  {name:<7} {np.mean(error):.4f}", Fore.CYAN)
@@ -0,0 +1,53 @@
+import sys
+import json
+import torch
+from pathlib import Path
+from colorama import Fore
+from datetime import datetime
+
+sys.path.append(str(Path(__file__).parent.parent))
+from common.config import *
+from common.utility import *
+from model.support import *
+from model.store import FEATURE_SHAPES, transform_version
+from model.transformer import build_model
+
+ENGINE_FILE = f"{DOWNLOAD_DIR}/transformer.pt2"
+
+
+def engine_meta(sizes, model_params):
+    return {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'sizes': sizes,
+        'model_params': model_params,
+        'schema': {
+            name: list(shape)
+            for name, shape in FEATURE_SHAPES.items()
+        },
+        'columns': COLUMN_TRANSFORM,
+        'transform_version': transform_version(),
+    }
+
+
+def export_model(model, sizes, model_params, engine_file):
+    model = model.to('cpu').float().eval()
+
+    # Everything but the batch dimension is fixed by the feature schema
+    example = tuple(torch.zeros((2, *FEATURE_SHAPES[name])) for name in ['run_hour', 'input', 'time'])
+    batch = torch.export.Dim('batch', min=1, max=1 << 16)
+
+    with torch.no_grad():
+        program = torch.export.export(model, example, dynamic_shapes=tuple({0: batch} for _ in example))
+
+    meta = json.dumps(engine_meta(sizes, model_params))
+    torch.export.save(program, engine_file, extra_files={'meta.json': meta})
+    print_log(f"Exported inference engine to {engine_file}", Fore.GREEN)
+
+
+def export_transformer(model_file=MODEL_FILE, engine_file=ENGINE_FILE):
+    sizes = feature_sizes({name: np.empty((1, *shape)) for name, shape in FEATURE_SHAPES.items()})
+
+    model = build_model(sizes)
+    model.load_state_dict(torch.load(model_file, map_location='cpu'))
+
+    export_model(model, sizes, MODEL_PARAMS, engine_file)
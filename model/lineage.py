@@ -0,0 +1,87 @@
+import os
+import sys
+import json
+import shutil
+from pathlib import Path
+from colorama import Fore
+from datetime import datetime
+
+sys.path.append(str(Path(__file__).parent.parent))
+from common.config import *
+from common.utility import *
+from model.store import file_digest
+
+LINEAGE_FILE = f"{DOWNLOAD_DIR}/lineage.json"
+MODEL_ARCHIVE_DIR = f"{DOWNLOAD_DIR}/models"
+
+
+def load_lineage():
+    if not Path(LINEAGE_FILE).exists():
+        return []
+
+    with open(LINEAGE_FILE, 'r') as f:
+        return json.load(f)
+
+
+def latest_version(lineage):
+    return lineage[-1] if lineage else None
+
+
+def version_runs(entry):
+    # Runs a version has been trained on, entries without a run list only recorded the range they covered
+    if 'runs_file' not in entry:
+        return None
+
+    with open(entry['runs_file'], 'r') as f:
+        return set(json.load(f))
+
+
+def record_version(model_file, mode, runs, new_runs, metrics):
+    # runs: the runs this version was trained on, new_runs: the ones no earlier version has seen
+    lineage = load_lineage()
+    parent = latest_version(lineage) if mode == 'finetune' else None
+    version = lineage[-1]['version'] + 1 if lineage else 1
+
+    # A fine-tuned model covers everything its parent did
+    covered = set(runs)
+    if parent:
+        covered |= version_runs(parent) or set()
+    first_run, last_run = min(covered), max(covered)
+    if parent:
+        first_run, last_run = min(first_run, parent['first_run']), max(last_run, parent['last_run'])
+
+    # Every version is kept so a bad refresh can be rolled back
+    Path(MODEL_ARCHIVE_DIR).mkdir(parents=True, exist_ok=True)
+    archive_file = f"{MODEL_ARCHIVE_DIR}/transformer_v{version}.pth"
+    shutil.copyfile(model_file, archive_file)
+
+    # The run list is kept next to the model, so later fine-tunes select runs by membership instead of by date
+    runs_file = f"{MODEL_ARCHIVE_DIR}/transformer_v{version}_runs.json"
+    with open(runs_file, 'w') as f:
+        json.dump(sorted(covered), f)
+
+    lineage.append({
+        'version': version,
+        'parent': parent['version'] if parent else None,
+        'mode': mode,
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'first_run': first_run,
+        'last_run': last_run,
+        'trained_runs': len(runs),
+        'new_runs': len(new_runs),
+        'model_file': archive_file,
+        'runs_file': runs_file,
+        'model_sha1': file_digest(model_file),
+        'metrics': {
+            name: value if isinstance(value, int) else float(value)
+            for name, value in metrics.items()
+        },
+    })
+
+    lineage_tmp = f"{LINEAGE_FILE}.tmp"
+    with open(lineage_tmp, 'w') as f:
+        json.dump(lineage, f, indent=2)
+    os.replace(lineage_tmp, LINEAGE_FILE)
+
+    print_log(f"Recorded model version {version} ({mode}) in {LINEAGE_FILE}", Fore.GREEN)
+    return version
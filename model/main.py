@@ -1,8 +1,8 @@
-import os
 import csv
 import sys
-import pandas as pd
-from metar import Metar
+import time
+import argparse
+import numpy as np
 from pathlib import Path
 from colorama import Fore
 from multiprocessing import Pool
@@ -11,8 +11,20 @@ from datetime import datetime, timedelta
 sys.path.append(str(Path(__file__).parent.parent))
 from common.config import *
 from common.utility import *
+from common.resources import *
+from common.tracing import *
 from model.transform import *
-from model.transformer import *
+from model.store import *
+from model.targets import *
+
+# torch, sklearn and pandas are imported by the code paths that use them so --help and
+# store-only work start without loading them
+
+# Runs in flight per worker and runs transformed together
+PIPELINE_WINDOW = 4
+TRANSFORM_CHUNK = 256
+
+EVENTS_FILE = f"{DOWNLOAD_DIR}/prepare_events.jsonl"
 
 
 def generate_test():
@@ -49,25 +61,6 @@ def filter_runs(runs):
     return _runs, ignore
 
 
-def load_metar(metar_file):
-    metar_data = []
-
-    try:
-        with open(metar_file, 'r') as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                valid_dt = datetime.strptime(row['valid'], '%Y-%m-%d %H:%M')
-                metar_data.append({'datetime': valid_dt, 'metar': row['metar']})
-    except FileNotFoundError:
-        print_log(f"Error: CSV file not found: {metar_file}", Fore.RED)
-        sys.exit(1)
-
-    metar_df = pd.DataFrame(metar_data)
-    metar_df.set_index('datetime', inplace=True)
-    metar_df.sort_index(inplace=True)
-    return metar_df
-
-
 def get_csv(file):
     if not Path(file).exists():
         print_log(f"Error: CSV file not found: {file}", Fore.RED)
@@ -78,102 +71,284 @@ def get_csv(file):
         return list(reader)
 
 
-def get_metar(run, metar_data):
-    run_metar_data = []
-    dt = parse_run_time(run)
+def init_worker(metar_data, events):
+    global worker_metar_data
+    worker_metar_data = metar_data
+    init_events(events)
 
-    start = dt
+    # Forked after torch may have started its thread pool, one thread per worker process
+    limit_threads(1)
 
-    # off-by-one bug here but needed - if start is 03:00 and ends at 14:00
-    # we miss the 14:50 report, so we extend to 15:00
-    end = dt + timedelta(hours=FORECAST_HOURS)
 
-    records = metar_data.loc[start:end]
+@traced
+def read_run(run):
+    start = time.perf_counter()
+    file = f"{CSV_DIR}/{run}.csv"
 
-    for dt_val, row in records.iterrows():
-        # Provide month and year context to prevent day 31 parsing errors
-        obs = Metar.Metar(row['metar'], month=dt_val.month, year=dt_val.year)
-        if obs.temp:
-            run_metar_data.append({'datetime': dt_val, 'temp': obs.temp.value()})
+    raw = np.array(get_raw(get_csv(file)), dtype=np.float64)
+    run_metar_data = get_metar(run, worker_metar_data)
+    filter_metar_data = filter_metar(run, run_metar_data)
 
-    return run_metar_data
+    log_event('read', run, time.perf_counter() - start, Path(file).stat().st_size)
+    return run, raw, filter_metar_data
 
 
-def filter_metar(run, run_metar_data):
-    filter_metar_data = []
+def stream_runs(runs, metar_data, events):
+    # One core is left to this process, it transforms the chunks the workers read
+    processes, _ = plan_workers(reserve=1)
+    print_plan("Reading runs", processes, 1)
 
-    run_dt = parse_run_time(run)
-    init_time = run_dt + timedelta(hours=FORECAST_PADDING)
-    cutoff_time = run_dt + timedelta(hours=FORECAST_FRAME)
+    # METAR records are shipped to each worker once instead of with every run
+    with Pool(processes=processes, initializer=init_worker, initargs=(metar_data, events)) as pool:
+        yield from imap_bounded(pool, read_run, runs, PIPELINE_WINDOW * processes)
+        pool.close()
+        pool.join()
 
-    # Remove first and last hour from METAR reports
-    # Filter out reports if they are not from xx:20 or xx:50
-    for metar_data in run_metar_data:
-        if metar_data['datetime'].minute in [20, 50]:
-            if init_time <= metar_data['datetime'] <= cutoff_time:
-                filter_metar_data.append(metar_data)
 
-    return filter_metar_data
+def stream_chunks(run_stream, size):
+    chunk = []
 
+    for run_data in run_stream:
+        chunk.append(run_data)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
 
-def process_run(args):
-    run, metar_data = args
-    file = f"{CSV_DIR}/{run}.csv"
+    if chunk:
+        yield chunk
 
-    run_csv_data = get_csv(file)
-    run_metar_data = get_metar(run, metar_data)
-    filter_metar_data = filter_metar(run, run_metar_data)
 
-    run_data = {'run_id': run, 'csv_data': run_csv_data, 'metar_data': filter_metar_data}
-    return run_data
+def write_features(runs, metar_data, manifest):
+    rows = {}
+    written = 0
+    reserved = reserve_features(manifest, len(runs))
+
+    # read -> transform -> write into the reserved rows, only one chunk of runs is held in memory
+    with event_sink(EVENTS_FILE) as events:
+        for chunk in stream_chunks(stream_runs(runs, metar_data, events), TRANSFORM_CHUNK):
+            start = time.perf_counter()
+            with span('transform', runs=len(chunk)):
+                run_ids, features = transform(chunk)
+            nbytes = sum(feature.nbytes for feature in features.values())
+            log_event('transform', duration=time.perf_counter() - start, nbytes=nbytes)
+
+            start = time.perf_counter()
+            with span('write_features', runs=len(run_ids)):
+                for name, feature in features.items():
+                    reserved[name][written:written + len(run_ids)] = feature
+            log_event('write', duration=time.perf_counter() - start, nbytes=nbytes)
+
+            for run_id in run_ids:
+                rows[run_id] = written
+                written += 1
+
+    first_row = commit_features(manifest, reserved, written)
+    print_log(f"Transformed {written} runs into {FEATURE_SHAPES['input']} features", Fore.GREEN)
+
+    return {run: first_row + row for run, row in rows.items()}
+
+
+def update_store(runs, manifest):
+    if not Path(METAR_FILE).exists():
+        print_log(f"Error: CSV file not found: {METAR_FILE}", Fore.RED)
+        sys.exit(1)
+
+    entries = manifest['runs']
+    metar_file = file_digest(METAR_FILE)
+    metar_changed = manifest['metar'] != metar_file
+
+    stale_runs = []
+    csv_digests = {}
+
+    for run in runs:
+        entry = entries.get(run)
+        csv_digests[run] = csv_digest(run, entry)
+
+        if entry is None or entry['csv'] != csv_digests[run][0]:
+            stale_runs.append(run)
+        else:
+            entry['stat'] = csv_digests[run][1]
+
+    if not stale_runs and not metar_changed:
+        return manifest
+
+    metar_data = load_metar(METAR_FILE)
+    print_log(f"Loaded {len(metar_data)} METAR records", Fore.GREEN)
+
+    # A new METAR file only invalidates the runs whose observation window changed. Every stored run is checked,
+    # not only the requested ones, because the manifest is marked as validated against the new file below.
+    check_runs = sorted(set(runs) | set(entries)) if metar_changed else stale_runs
+    metar_digests = {run: metar_digest(get_metar_records(run, metar_data)) for run in check_runs}
 
+    if metar_changed:
+        stale = set(stale_runs)
+        stale_runs = [run for run in runs if run in stale or entries[run]['metar'] != metar_digests[run]]
 
-def process_runs(runs, metar_data):
-    num_cores = os.cpu_count()
-    print_log(f"Using {num_cores} CPU cores for parallel processing")
+        # Changed runs outside this call are forgotten, so they are prepared again the next time they are requested
+        requested = set(runs)
+        for run in [run for run in entries if run not in requested and entries[run]['metar'] != metar_digests[run]]:
+            del entries[run]
 
-    args_list = [(run, metar_data) for run in runs]
+    print_log(f"Preparing {len(stale_runs)} new or changed runs\n", Fore.GREEN)
 
-    with Pool(processes=num_cores) as pool:
-        runs_data = pool.map(process_run, args_list)
+    rows = {}
+    if stale_runs:
+        rows = write_features(stale_runs, metar_data, manifest)
 
-    return runs_data
+    for run in stale_runs:
+        csv_hash, csv_stat = csv_digests[run]
+        entries[run] = {'csv': csv_hash, 'stat': csv_stat, 'metar': metar_digests[run], 'row': rows.get(run)}
 
+    manifest['metar'] = metar_file
+    return manifest
 
-def prepare_data(runs):
+
+@traced
+def prepare_data(runs, update=True):
     print_log(f"Generated {len(runs)} runs", Fore.GREEN)
 
     runs, ignore = filter_runs(runs)
     print_log(f"Ignored {ignore} runs", Fore.MAGENTA)
 
+    # Without update the store is only read, it must already hold every run
+    manifest = load_manifest()
+    if update:
+        manifest = update_store(runs, manifest)
+        save_manifest(manifest)
+        compact_features(manifest)
+
+    features = select_features(manifest, runs)
+    print_log(f"Loaded {len(features['run_id'])} runs from feature store\n", Fore.GREEN)
+
+    return features
+
+
+def load_ensemble_runs(start, end):
+    from model.ensemble import covering_runs
+
+    runs, ignore = filter_runs(covering_runs(start, end))
+    available = [run for run in runs if Path(f"{CSV_DIR}/{run}.csv").exists()]
+
+    print_log(f"{len(available)} runs cover {start} - {end}, {ignore} ignored, {len(runs) - len(available)} missing",
+              Fore.GREEN)
+
+    raws = [np.array(get_raw(get_csv(f"{CSV_DIR}/{run}.csv")), dtype=np.float64) for run in available]
+    return available, raws
+
+
+def load_observed(start, end):
+    if not Path(METAR_FILE).exists():
+        return {}
+
     metar_data = load_metar(METAR_FILE)
-    print_log(f"Loaded {len(metar_data)} METAR records\n", Fore.GREEN)
+    return {metar['datetime'].to_pydatetime(): metar['temp'] for metar in parse_metar(metar_data.loc[start:end])}
 
-    runs_data = process_runs(runs, metar_data)
-    transformed_data = transform(runs_data)
 
-    return transformed_data
+def run_ensemble(start, end, device, int8=False):
+    from model.support import feature_sizes
+    from model.transformer import load_model
+    from model.ensemble import ensemble_forecast, report_ensemble
 
+    if int8 and device.type != 'cpu':
+        print_log("Quantized model only runs on CPU", Fore.RED)
+        sys.exit(1)
 
-def main():
-    if len(sys.argv) != 2:
-        print_log(f"Usage: python {sys.argv[0]} [train|test]", Fore.RED)
+    runs, raws = load_ensemble_runs(start, end)
+    if not runs:
+        print_log("No runs available for the ensemble", Fore.RED)
         sys.exit(1)
 
-    input = sys.argv[1]
+    sizes = feature_sizes({name: np.empty((1, *shape)) for name, shape in FEATURE_SHAPES.items()})
+    model = load_model(sizes, device, int8)
 
-    if input not in ["train", "test"]:
-        print_log(f"Usage: python {sys.argv[0]} [train|test]", Fore.RED)
-        sys.exit(1)
+    forecast = ensemble_forecast(model, device, runs, raws, start, end, amp=not int8)
+    report_ensemble(forecast, load_observed(start, end))
+
+
+def train_worker(args):
+    import torch.distributed as dist
+    from model.distributed import init_distributed, train_distributed
+
+    rank, _ = init_distributed()
+    runs = generate_runs()
+
+    # One process in the whole job updates the feature store (shared between nodes), the others read it once it is done
+    if rank == 0:
+        features = prepare_data(runs)
+    dist.barrier()
+    if rank != 0:
+        features = prepare_data(runs, update=False)
+
+    train_distributed(features, args.compile, tuple(args.profile), args.resume)
+    dist.destroy_process_group()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train or test the temperature model")
+    parser.add_argument('mode', choices=['train', 'finetune', 'test', 'export', 'quantize', 'ensemble', 'distill'])
+    parser.add_argument('--device', default=None, help="cpu, cuda or cuda:N (default: cuda:0 when available)")
+    parser.add_argument('--compile', action='store_true', help="run the model through torch.compile")
+    parser.add_argument('--int8', action='store_true', help="test with the dynamic int8 model (CPU only)")
+    parser.add_argument('--profile',
+                        type=int,
+                        nargs=2,
+                        default=(0, 0),
+                        metavar=('START', 'STEPS'),
+                        help="record STEPS training steps after START steps to a Chrome trace")
+    parser.add_argument('--procs', type=int, default=1, help="data-parallel training processes on this machine (CPU, gloo)")
+    parser.add_argument('--resume', action='store_true', help="continue training from the last checkpoint")
+    parser.add_argument('--students', nargs='+', help="student configs to distill (default: all)")
+    parser.add_argument('--start', default="20230701T0000Z", help="ensemble window start (YYYYMMDDTHHMMZ)")
+    parser.add_argument('--end', default="20230701T2359Z", help="ensemble window end (YYYYMMDDTHHMMZ)")
+    args = parser.parse_args()
+
+    if args.mode == "export":
+        from model.export import export_transformer
+        export_transformer()
+        return
+
+    from model.support import select_device
+    from model.distributed import is_distributed_env, launch_local
 
     print_log("Starting METAR data processing\n", Fore.GREEN)
 
-    if input == "train":
+    # Data-parallel training, started by torchrun (multi-node) or spawned here
+    if args.mode == "train" and is_distributed_env():
+        train_worker(args)
+        return
+    if args.mode == "train" and args.procs > 1:
+        launch_local(train_worker, args.procs, args)
+        return
+
+    device = select_device(args.device)
+
+    if args.mode == "train":
+        from model.transformer import train_transformer
+        runs = generate_runs()
+        train_transformer(prepare_data(runs), device, args.compile, tuple(args.profile), args.resume)
+    elif args.mode == "finetune":
+        from model.transformer import finetune_transformer
         runs = generate_runs()
-        train_transformer(prepare_data(runs))
-    elif input == "test":
+        finetune_transformer(prepare_data(runs), device)
+    elif args.mode == "test":
+        from model.transformer import test_transformer
         runs_test = generate_test()
-        test_transformer(prepare_data(runs_test))
+        test_transformer(prepare_data(runs_test), device, args.compile, args.int8)
+    elif args.mode == "quantize":
+        from model.transformer import quantize_transformer
+        runs = generate_runs()
+        quantize_transformer(prepare_data(runs))
+    elif args.mode == "distill":
+        from model.transformer import distill_transformer, STUDENT_CONFIGS
+        unknown = [name for name in args.students or [] if name not in STUDENT_CONFIGS]
+        if unknown:
+            print_log(f"Error: unknown students {unknown}, choose from {list(STUDENT_CONFIGS)}", Fore.RED)
+            sys.exit(1)
+
+        runs = generate_runs()
+        distill_transformer(prepare_data(runs), device, args.students)
+    elif args.mode == "ensemble":
+        run_ensemble(parse_run_time(args.start), parse_run_time(args.end), device, args.int8)
 
 
 if __name__ == "__main__":
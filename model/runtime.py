@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+# Minimal inference runtime for artifacts written by model/export.py, needs torch and numpy only
+
+import sys
+import json
+import time
+import torch
+import numpy as np
+
+INPUT_FIELDS = ['run_hour', 'input', 'time']
+
+
+class InferenceEngine:
+
+    def __init__(self, engine_file, threads=None):
+        if threads:
+            torch.set_num_threads(threads)
+
+        extra_files = {'meta.json': ''}
+        program = torch.export.load(engine_file, extra_files=extra_files)
+
+        self.module = program.module()
+        self.meta = json.loads(extra_files['meta.json'])
+
+    def check(self, name, array):
+        shape = tuple(self.meta['schema'][name])
+        if array.ndim != len(shape) + 1 or array.shape[1:] != shape:
+            raise ValueError(f"{name}: expected (batch, {', '.join(map(str, shape))}), got {array.shape}")
+
+    def predict(self, run_hour, input, time):
+        batch = {'run_hour': run_hour, 'input': input, 'time': time}
+
+        tensors = []
+        for name in INPUT_FIELDS:
+            array = np.ascontiguousarray(batch[name], dtype=np.float32)
+            self.check(name, array)
+            tensors.append(torch.from_numpy(array))
+
+        with torch.inference_mode():
+            return self.module(*tensors).numpy()
+
+
+def main():
+    if len(sys.argv) != 2:
+        print(f"Usage: python {sys.argv[0]} <engine_file>")
+        sys.exit(1)
+
+    start = time.perf_counter()
+    engine = InferenceEngine(sys.argv[1])
+    load_time = time.perf_counter() - start
+
+    schema = engine.meta['schema']
+    batch = [np.zeros((1, *schema[name]), dtype=np.float32) for name in INPUT_FIELDS]
+
+    start = time.perf_counter()
+    engine.predict(*batch)
+    predict_time = time.perf_counter() - start
+
+    print(json.dumps({'load_s': load_time, 'first_predict_s': predict_time}))
+
+
+if __name__ == "__main__":
+    main()
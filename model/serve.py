@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+
+import sys
+import json
+import time
+import queue
+import argparse
+import threading
+import torch
+import numpy as np
+from pathlib import Path
+from colorama import Fore
+from collections import deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.append(str(Path(__file__).parent.parent))
+from common.config import *
+from common.utility import *
+from model.transform import *
+from model.store import FEATURE_SHAPES, FCST_STEPS
+from model.transformer import *
+from model.runtime import INPUT_FIELDS
+
+SERVE_HOST = "127.0.0.1"
+SERVE_PORT = 8650
+
+# Requests that arrive while a batch is running are predicted together in the next one
+MAX_BATCH = 256
+LATENCY_WINDOW = 10000
+
+
+def parse_request(payload):
+    # {"run": "YYYYMMDDTHHMMZ", "rows": [24 CSV rows], "time": optional ["YYYYMMDDTHHMMZ", ...]}
+    run = payload['run']
+    raw = np.array(get_raw(payload['rows']), dtype=np.float64)
+    if raw.shape != (FORECAST_HOURS, len(COLUMN_PROCESS)):
+        raise ValueError(f"rows: expected {FORECAST_HOURS} rows of {len(COLUMN_PROCESS)} fields, got {raw.shape}")
+
+    if 'time' in payload:
+        times = [parse_run_time(dt) for dt in payload['time']]
+    else:
+        times = forecast_times(run)
+
+    if len(times) != FCST_STEPS:
+        raise ValueError(f"time: expected {FCST_STEPS} forecast times, got {len(times)}")
+
+    return times, transform_run(run, raw, times)
+
+
+class PredictionBatcher:
+
+    def __init__(self, model, device):
+        self.model = model
+        self.device = device
+
+        # Batches are small, bfloat16 autocast costs more than it saves on CPU at these sizes
+        self.amp = device.type != 'cpu'
+
+        self.requests = queue.Queue()
+        self.stats_lock = threading.Lock()
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.batch_sizes = deque(maxlen=LATENCY_WINDOW)
+
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def submit(self, features):
+        request = {'features': features, 'done': threading.Event()}
+        self.requests.put(request)
+        request['done'].wait()
+
+        if 'error' in request:
+            raise RuntimeError(request['error'])
+        return request['temp']
+
+    def collect(self):
+        batch = [self.requests.get()]
+
+        while len(batch) < MAX_BATCH:
+            try:
+                batch.append(self.requests.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def predict(self, features):
+        tensors = []
+        for name in INPUT_FIELDS:
+            array = np.stack([feature[name] for feature in features]).astype(np.float32)
+            tensors.append(torch.from_numpy(array).to(self.device))
+
+        with torch.inference_mode(), autocast(self.device, enabled=self.amp):
+            return self.model(*tensors).float().cpu().numpy()
+
+    def run(self):
+        while True:
+            batch = self.collect()
+
+            try:
+                temps = self.predict([request['features'] for request in batch])
+                for request, temp in zip(batch, temps):
+                    request['temp'] = temp
+            except Exception as e:
+                for request in batch:
+                    request['error'] = str(e)
+
+            with self.stats_lock:
+                self.batch_sizes.append(len(batch))
+
+            for request in batch:
+                request['done'].set()
+
+    def record(self, latency):
+        with self.stats_lock:
+            self.latencies.append(latency)
+
+    def stats(self):
+        with self.stats_lock:
+            latencies = np.array(self.latencies)
+            batch_sizes = np.array(self.batch_sizes)
+
+        if len(latencies) == 0:
+            return {'requests': 0}
+
+        p50, p99 = np.percentile(latencies * 1e3, [50, 99])
+        return {
+            'requests': len(latencies),
+            'p50_ms': round(p50, 3),
+            'p99_ms': round(p99, 3),
+            'mean_batch': round(batch_sizes.mean(), 2),
+        }
+
+
+class PredictionHandler(BaseHTTPRequestHandler):
+    batcher = None
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode()
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self.send_json(200, self.batcher.stats())
+        else:
+            self.send_json(404, {'error': f"unknown path {self.path}"})
+
+    def do_POST(self):
+        if self.path != '/predict':
+            self.send_json(404, {'error': f"unknown path {self.path}"})
+            return
+
+        start = time.perf_counter()
+
+        try:
+            payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            times, features = parse_request(payload)
+        except KeyError as e:
+            self.send_json(400, {'error': f"missing field {e}"})
+            return
+        except (ValueError, TypeError) as e:
+            self.send_json(400, {'error': str(e)})
+            return
+
+        try:
+            temps = self.batcher.submit(features)
+        except RuntimeError as e:
+            self.send_json(500, {'error': str(e)})
+            return
+
+        self.batcher.record(time.perf_counter() - start)
+        self.send_json(
+            200, {
+                'run': payload['run'],
+                'time': [dt.strftime("%Y%m%dT%H%MZ") for dt in times],
+                'temp': [round(float(temp), 2) for temp in temps],
+            })
+
+    def log_message(self, format, *args):
+        pass
+
+
+def warm_up(batcher):
+    # First forward pass allocates and initialises kernels, keep it out of request latency
+    features = {name: np.zeros(FEATURE_SHAPES[name], dtype=np.float32) for name in INPUT_FIELDS}
+    batcher.predict([features])
+
+
+def create_server(model, device, host=SERVE_HOST, port=SERVE_PORT):
+    batcher = PredictionBatcher(model, device)
+    warm_up(batcher)
+
+    handler = type('Handler', (PredictionHandler, ), {'batcher': batcher})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve temperature predictions over HTTP")
+    parser.add_argument('--host', default=SERVE_HOST)
+    parser.add_argument('--port', type=int, default=SERVE_PORT)
+    parser.add_argument('--device', default=None, help="cpu, cuda or cuda:N (default: cuda:0 when available)")
+    parser.add_argument('--int8', action='store_true', help="serve the dynamic int8 model (CPU only)")
+    args = parser.parse_args()
+
+    device = select_device('cpu' if args.int8 else args.device)
+    sizes = feature_sizes({name: np.empty((1, *shape)) for name, shape in FEATURE_SHAPES.items()})
+    model = load_model(sizes, device, args.int8)
+
+    server = create_server(model, device, args.host, args.port)
+    print_log(f"Serving predictions on http://{args.host}:{args.port} (POST /predict, GET /stats)", Fore.GREEN)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print_log(f"Latency: {server.RequestHandlerClass.batcher.stats()}", Fore.CYAN)
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
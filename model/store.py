@@ -0,0 +1,221 @@
+import os
+import sys
+import json
+import hashlib
+import numpy as np
+from pathlib import Path
+from colorama import Fore
+
+sys.path.append(str(Path(__file__).parent.parent))
+from common.config import *
+from common.utility import *
+from model.transform import FORECAST_PADDING, FORECAST_FRAME
+
+FEATURE_DIR = f"{DOWNLOAD_DIR}/features"
+MANIFEST_FILE = f"{FEATURE_DIR}/manifest.json"
+
+# Rows of changed runs stay in the files until they make up this fraction of the store, then the live rows are
+# copied into a new generation of files
+COMPACT_RATIO = 0.25
+COMPACT_CHUNK = 4096
+
+FCST_STEPS = FORECAST_FRAME - FORECAST_PADDING
+
+FEATURE_SHAPES = {
+    'run_hour': (2, ),
+    'input': (FORECAST_HOURS, len(COLUMN_TRANSFORM)),
+    'time': (FCST_STEPS, 2),
+    'temp': (FCST_STEPS, ),
+}
+
+# Any change to these files invalidates every stored run: the features and the METAR targets they are paired with
+TRANSFORM_SOURCES = [
+    Path(__file__).parent / "transform.py",
+    Path(__file__).parent / "encoding.py",
+    Path(__file__).parent / "targets.py",
+]
+
+
+def transform_version():
+    digest = hashlib.sha1()
+
+    for source in TRANSFORM_SOURCES:
+        digest.update(source.read_bytes())
+
+    constants = [COLUMN_PROCESS, COLUMN_TRANSFORM, FEATURE_SHAPES, FORECAST_HOURS, FORECAST_PADDING, FORECAST_FRAME]
+    digest.update(json.dumps(constants).encode())
+    return digest.hexdigest()
+
+
+def file_digest(file):
+    digest = hashlib.sha1()
+
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def csv_digest(run, entry):
+    file = Path(f"{CSV_DIR}/{run}.csv")
+    if not file.exists():
+        print_log(f"Error: CSV file not found: {file}", Fore.RED)
+        sys.exit(1)
+
+    # Skip re-hashing files that have not been touched since they were stored
+    stat = file.stat()
+    file_stat = [stat.st_size, stat.st_mtime_ns]
+
+    if entry and entry['stat'] == file_stat:
+        return entry['csv'], file_stat
+    return file_digest(file), file_stat
+
+
+def metar_digest(records):
+    return hashlib.sha1('\n'.join(records['metar']).encode()).hexdigest()
+
+
+def feature_file(name, generation):
+    return Path(FEATURE_DIR) / f"{name}.{generation}.f32"
+
+
+def empty_manifest(version, generation=0):
+    return {'version': version, 'metar': None, 'count': 0, 'generation': generation, 'runs': {}}
+
+
+def load_manifest():
+    version = transform_version()
+
+    if not Path(MANIFEST_FILE).exists():
+        return empty_manifest(version)
+
+    with open(MANIFEST_FILE, 'r') as f:
+        manifest = json.load(f)
+
+    if manifest['version'] != version:
+        print_log("Feature store was built by a different transform, rebuilding", Fore.YELLOW)
+        return empty_manifest(version, manifest.get('generation', 0))
+
+    return manifest
+
+
+def save_manifest(manifest):
+    Path(FEATURE_DIR).mkdir(parents=True, exist_ok=True)
+    manifest_tmp = f"{MANIFEST_FILE}.tmp"
+
+    with open(manifest_tmp, 'w') as f:
+        json.dump(manifest, f)
+
+    os.replace(manifest_tmp, MANIFEST_FILE)
+
+
+def row_size(shape):
+    return int(np.prod(shape)) * np.dtype(np.float32).itemsize
+
+
+def reserve_features(manifest, size):
+    Path(FEATURE_DIR).mkdir(parents=True, exist_ok=True)
+    count = manifest['count']
+
+    # Grow every file by `size` rows and hand out writable maps over the new rows only
+    reserved = {}
+    for name, shape in FEATURE_SHAPES.items():
+        file = feature_file(name, manifest['generation'])
+        file.touch()
+        os.truncate(file, (count + size) * row_size(shape))
+
+        reserved[name] = np.memmap(file, dtype=np.float32, mode='r+', offset=count * row_size(shape), shape=(size, *shape))
+
+    return reserved
+
+
+def commit_features(manifest, reserved, used):
+    count = manifest['count']
+
+    for feature in reserved.values():
+        feature.flush()
+    reserved.clear()
+
+    # Drop the reserved rows that were never filled (runs without a full set of METAR reports)
+    for name, shape in FEATURE_SHAPES.items():
+        os.truncate(feature_file(name, manifest['generation']), (count + used) * row_size(shape))
+
+    manifest['count'] += used
+    return count
+
+
+def open_features(manifest):
+    features = {}
+
+    for name, shape in FEATURE_SHAPES.items():
+        if manifest['count'] == 0:
+            features[name] = np.zeros((0, *shape), dtype=np.float32)
+        else:
+            features[name] = np.memmap(feature_file(name, manifest['generation']),
+                                       dtype=np.float32,
+                                       mode='r',
+                                       shape=(manifest['count'], *shape))
+
+    return features
+
+
+def select_features(manifest, runs):
+    run_ids = []
+    rows = []
+
+    for run in runs:
+        row = manifest['runs'][run]['row']
+        if row is not None:
+            run_ids.append(run)
+            rows.append(row)
+
+    features = open_features(manifest)
+
+    # Whole store in order stays memory-mapped, any other selection is gathered into memory
+    if rows != list(range(manifest['count'])):
+        rows = np.array(rows, dtype=np.int64)
+        features = {name: np.asarray(feature[rows]) for name, feature in features.items()}
+
+    features['run_id'] = run_ids
+    return features
+
+
+def compact_features(manifest):
+    live = sorted((run, entry['row']) for run, entry in manifest['runs'].items() if entry['row'] is not None)
+    count = manifest['count']
+
+    if count == 0 or (count - len(live)) / count < COMPACT_RATIO:
+        return
+
+    print_log(f"Compacting feature store: {count - len(live)} of {count} rows belong to replaced runs", Fore.YELLOW)
+
+    # Live rows are written in run order, so the store read whole for the generated runs stays memory-mapped
+    rows = np.array([row for _, row in live], dtype=np.int64)
+    generation = manifest['generation'] + 1
+    features = open_features(manifest)
+
+    for name, shape in FEATURE_SHAPES.items():
+        file = feature_file(name, generation)
+        file.touch()
+        os.truncate(file, len(rows) * row_size(shape))
+        if len(rows) == 0:
+            continue
+
+        compacted = np.memmap(file, dtype=np.float32, mode='r+', shape=(len(rows), *shape))
+        for start in range(0, len(rows), COMPACT_CHUNK):
+            compacted[start:start + COMPACT_CHUNK] = features[name][rows[start:start + COMPACT_CHUNK]]
+        compacted.flush()
+        del compacted
+    features.clear()
+
+    for row, (run, _) in enumerate(live):
+        manifest['runs'][run]['row'] = row
+
+    # The manifest switches to the new files in one replace, the old ones are only removed after that
+    old_generation = manifest['generation']
+    manifest['count'] = len(live)
+    manifest['generation'] = generation
+    save_manifest(manifest)
+
+    for name in FEATURE_SHAPES:
+        feature_file(name, old_generation).unlink(missing_ok=True)
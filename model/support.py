@@ -1,19 +1,56 @@
 import os
 import sys
 import math
+import time
+import queue
 import torch
+import resource
+import threading
 import torch.nn as nn
 import numpy as np
 from pathlib import Path
-from sklearn.metrics import mean_absolute_error, r2_score
+from contextlib import contextmanager
 
 sys.path.append(str(Path(__file__).parent.parent))
 from common.config import *
 from common.utility import *
-
-DEVICE = torch.device('cuda:0')
+from common.resources import *
+from common.tracing import *
 
 MODEL_FILE = f"{DOWNLOAD_DIR}/transformer.pth"
+QUANTIZED_FILE = f"{DOWNLOAD_DIR}/transformer_int8.pth"
+TRACE_FILE = f"{DOWNLOAD_DIR}/train_trace.json"
+CHECKPOINT_FILE = f"{DOWNLOAD_DIR}/checkpoint.pth"
+OPTIMIZER_FILE = f"{DOWNLOAD_DIR}/optimizer.pth"
+TEST_PREDICTIONS_FILE = f"{DOWNLOAD_DIR}/test_predictions.npz"
+CHECKPOINT_EVERY = 5
+
+MODEL_PARAMS = {'d_model': 256, 'nhead': 8, 'enc_layers': 6, 'dec_layers': 4, 'dim_feedforward': 1024, 'dropout': 0.1}
+TRAIN_PARAMS = {'learning_rate': 0.0001, 'epochs': 500, 'l2_reg_weight': 0.001}
+FINETUNE_PARAMS = {'learning_rate': 0.00002, 'epochs': 20, 'l2_reg_weight': 0.001}
+
+# Distilled students, a config with 'hidden' builds the attention-free MLP
+STUDENT_CONFIGS = {
+    'small': dict(d_model=128, nhead=4, enc_layers=3, dec_layers=2, dim_feedforward=512, dropout=0.1),
+    'tiny': dict(d_model=64, nhead=4, enc_layers=2, dec_layers=1, dim_feedforward=256, dropout=0.1),
+    'mlp': dict(hidden=256, layers=2, dropout=0.1),
+}
+STUDENT_DIR = f"{DOWNLOAD_DIR}/students"
+
+# Weight of the teacher's prediction in a student's target, the rest is the observation
+DISTILL_ALPHA = 0.7
+LATENCY_REPEAT = 200
+
+# Older runs replayed during fine-tuning, per new run. At least one new run is held out for validation.
+REPLAY_RATIO = 2
+FINETUNE_MIN_RUNS = 2
+
+# Peak RSS of one training process: torch runtime, model, AdamW state and activations at BATCH_SIZE
+TRAIN_MEMORY = 2 * 2**30
+
+DATASET_FIELDS = ['run_hour', 'input', 'time', 'temp']
+PREP_CHUNK = 4096
+BATCH_SIZE = 128
 
 
 # Based on "Attention is All You Need" - Vaswani et al. (2017) for "batch_first=True"
@@ -35,42 +72,344 @@ class PositionalEncoding(nn.Module):
 
     def forward(self, x):
         seq_len = x.size(1)
-        return x + self.pe[:, :seq_len, :].to(x.device)
+        return x + self.pe[:, :seq_len, :]
+
+
+# Smooth rounding from https://arxiv.org/abs/2504.19026 over the 5 nearest integers n in [floor(x)-2, floor(x)+2].
+# Neighbouring windows share an edge (n's right sigmoid is n+1's left), so the sum telescopes to
+# (f-2)·σ_0 + σ_1 + σ_2 + σ_3 + σ_4 - (f+2)·σ_5 with f = floor(x): 6 sigmoids in one broadcast instead of 10,
+# and an analytic backward that only keeps x alive.
+class SmoothRound(torch.autograd.Function):
+
+    @staticmethod
+    def sigmoids(x, k):
+        x_floor = torch.floor(x)
+
+        # σ(k(x-(n-0.5))) for n = f-2 .. f+3, written relative to f
+        edges = torch.tensor([2.5, 1.5, 0.5, -0.5, -1.5, -2.5], dtype=x.dtype, device=x.device)
+        return x_floor, torch.sigmoid(k * ((x - x_floor).unsqueeze(-1) + edges))
+
+    @staticmethod
+    def combine(x_floor, s):
+        return (x_floor - 2) * s[..., 0] + s[..., 1:5].sum(-1) - (x_floor + 2) * s[..., 5]
+
+    @staticmethod
+    def forward(ctx, x, k):
+        k = torch.as_tensor(k, dtype=x.dtype, device=x.device)
+        x_floor, s = SmoothRound.sigmoids(x, k)
+
+        ctx.save_for_backward(x, k)
+        return SmoothRound.combine(x_floor, s)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        x, k = ctx.saved_tensors
+        x_floor, s = SmoothRound.sigmoids(x, k)
+
+        # d/dx σ(k(x-c)) = k·σ·(1-σ), floor(x) is piecewise constant and contributes nothing
+        return grad_output * k * SmoothRound.combine(x_floor, s * (1 - s)), None
+
+
+def rounding_k(epoch, max_epochs):
+    # SmoothRound sharpness for training, reaches k=20 by 1/2 of training (before typical early stopping)
+    progress = min(epoch / max(1, max_epochs // 2), 1.0)
+    return 5 + progress * 15  # k: 5→20
+
+
+def configure_cpu_threads(threads=None):
+    cores = threads or cpu_budget()
+
+    # One intra-op thread per core, a few inter-op threads for independent ops (attention heads, etc.)
+    torch.set_num_threads(cores)
+    try:
+        torch.set_num_interop_threads(max(1, min(4, cores // 4)))
+    except RuntimeError:
+        # Can only be set once, before any inter-op work has started
+        pass
+
+    print_log(f"Using {torch.get_num_threads()} intra-op and {torch.get_num_interop_threads()} inter-op CPU threads")
+
+
+def cpu_supports_bf16():
+    # Without native bf16 (AVX512-BF16 or AMX) autocast on CPU is slower than plain float32
+    return torch.cpu._is_avx512_bf16_supported() or torch.cpu._is_amx_tile_supported()
+
+
+def select_device(name=None):
+    if name is None:
+        name = 'cuda:0' if torch.cuda.is_available() else 'cpu'
+
+    device = torch.device(name)
+    if device.type == 'cpu':
+        configure_cpu_threads()
+
+    print_log(f"Using device {device} with {amp_dtype(device)} autocast", Fore.CYAN)
+    return device
+
+
+def amp_dtype(device):
+    if device.type == 'cuda':
+        return torch.float16
+    if cpu_supports_bf16():
+        return torch.bfloat16
+    return torch.float32
+
+
+def autocast(device, enabled=True):
+    dtype = amp_dtype(device)
+    return torch.amp.autocast(device.type, dtype=dtype, enabled=enabled and dtype != torch.float32)
+
+
+def grad_scaler(device):
+    # Loss scaling is only needed for float16, bfloat16 has the float32 exponent range
+    return torch.amp.GradScaler(device.type, enabled=amp_dtype(device) == torch.float16)
+
+
+def compile_model(model):
+    # In-place compile keeps parameter names, so saved state dicts load into eager models unchanged
+    print_log("Compiling model with torch.compile", Fore.CYAN)
+    model.compile(dynamic=False)
+    return model
+
+
+def model_device(model):
+    return next(model.parameters()).device
+
 
+class PhaseTimer:
 
-def eval_model(model, dataloader):
+    def __init__(self, device, sync=False):
+        # sync: wait for CUDA after every phase so its work is charged to the phase that queued it (used while
+        # profiling), otherwise CUDA phases are timed on the stream with events and only read back in summary()
+        self.device = device
+        self.events = self.device.type == 'cuda' and not sync
+        self.totals = {}
+        self.pending = []
+
+    @contextmanager
+    def phase(self, name):
+        # Labelled in profiler and pipeline traces too
+        with torch.profiler.record_function(name), span(name):
+            if self.events:
+                start = torch.cuda.Event(enable_timing=True)
+                start.record()
+                yield
+                end = torch.cuda.Event(enable_timing=True)
+                end.record()
+                self.pending.append((name, start, end))
+                return
+
+            start = time.perf_counter()
+            yield
+            if self.device.type == 'cuda':
+                torch.cuda.synchronize(self.device)
+            self.totals[name] = self.totals.get(name, 0) + time.perf_counter() - start
+
+    def reset(self):
+        self.totals = {}
+        self.pending = []
+
+    def summary(self):
+        if self.pending:
+            self.pending[-1][2].synchronize()
+        for name, start, end in self.pending:
+            self.totals[name] = self.totals.get(name, 0) + start.elapsed_time(end) / 1000
+        self.pending = []
+
+        total = sum(self.totals.values())
+        return ", ".join(f"{name} {seconds:.2f}s ({seconds / total:.0%})" for name, seconds in self.totals.items())
+
+
+def reset_peak_memory(device):
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+
+
+def peak_memory(device):
+    # CUDA: peak allocated since the last reset, CPU: peak resident size of the process (KiB on Linux)
+    if device.type == 'cuda':
+        return f"{torch.cuda.max_memory_allocated(device) / 2**20:.0f} MiB allocated"
+    return f"{resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10:.0f} MiB RSS"
+
+
+def training_profiler(device, start, steps):
+    if not steps:
+        return None
+
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if device.type == 'cuda':
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+
+    def export_trace(profiler):
+        profiler.export_chrome_trace(TRACE_FILE)
+        print_log(f"Saved profiler trace to {TRACE_FILE}", Fore.GREEN)
+
+    # Skip `start` steps, one warm-up step, then record `steps` steps
+    schedule = torch.profiler.schedule(skip_first=start, wait=0, warmup=1, active=steps, repeat=1)
+    profiler = torch.profiler.profile(activities=activities,
+                                      schedule=schedule,
+                                      on_trace_ready=export_trace,
+                                      profile_memory=True)
+    profiler.start()
+    return profiler
+
+
+def snapshot(state):
+    # Detached CPU copy of a (nested) state dict, safe to hand to another thread while training continues
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return {key: snapshot(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot(value) for value in state)
+    return state
+
+
+def rng_state(device):
+    state = {'torch': torch.get_rng_state()}
+    if device.type == 'cuda':
+        state['cuda'] = torch.cuda.get_rng_state(device)
+    return state
+
+
+def set_rng_state(device, state):
+    torch.set_rng_state(state['torch'])
+    if device.type == 'cuda':
+        torch.cuda.set_rng_state(state['cuda'], device)
+
+
+class CheckpointWriter:
+
+    def __init__(self, checkpoint_file):
+        self.checkpoint_file = checkpoint_file
+
+        # At most one checkpoint waits behind the one being written
+        self.pending = queue.Queue(maxsize=1)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def save(self, state):
+        self.pending.put(state)
+
+    def run(self):
+        while True:
+            state = self.pending.get()
+            if state is None:
+                return
+
+            try:
+                Path(self.checkpoint_file).parent.mkdir(parents=True, exist_ok=True)
+                checkpoint_tmp = f"{self.checkpoint_file}.tmp"
+                torch.save(state, checkpoint_tmp)
+                os.replace(checkpoint_tmp, self.checkpoint_file)
+            except Exception as e:
+                print_log_t(f"Error: failed to write checkpoint {self.checkpoint_file}: {e}", Fore.RED)
+
+    def close(self):
+        self.pending.put(None)
+        self.thread.join()
+
+
+def load_checkpoint(checkpoint_file):
+    if not Path(checkpoint_file).exists():
+        print_log(f"Error: checkpoint not found: {checkpoint_file}", Fore.RED)
+        sys.exit(1)
+
+    # Everything stays on CPU, load_state_dict moves it next to the parameters
+    return torch.load(checkpoint_file, map_location='cpu')
+
+
+class MetricsAccumulator:
+
+    def __init__(self, steps, shift=None):
+        # Running sums per lead hour: error, |error|, error², target, target². Targets are shifted by the
+        # first batch's mean (or `shift`) so the R² variance term does not cancel out in large sums
+        self.count = 0
+        self.shift = shift
+        self.sums = torch.zeros((5, steps), dtype=torch.float64)
+
+    def update(self, preds, targets):
+        preds, targets = preds.detach().cpu().double(), targets.detach().cpu().double()
+        if self.shift is None:
+            self.shift = targets.mean()
+
+        error = preds - targets
+        targets = targets - self.shift
+        self.count += preds.size(0)
+        self.sums += torch.stack([error.sum(0), error.abs().sum(0), (error**2).sum(0), targets.sum(0), (targets**2).sum(0)])
+
+    @staticmethod
+    def summarize(sums, count):
+        error, abs_error, sq_error, target, sq_target = sums
+        return {
+            'mae': abs_error / count,
+            'rmse': torch.sqrt(sq_error / count),
+            'bias': error / count,
+            'r2': 1 - sq_error / (sq_target - target**2 / count),
+        }
+
+    def metrics(self):
+        # Overall numbers match sklearn over the flattened (samples, lead) arrays
+        overall = self.summarize(self.sums.sum(1), self.count * self.sums.size(1))
+        lead = self.summarize(self.sums, self.count)
+
+        metrics = {name: value.item() for name, value in overall.items()}
+        metrics['lead'] = {name: value.numpy() for name, value in lead.items()}
+        return metrics
+
+
+def eval_batches(model, dataloader, amp=True):
+    device = model_device(model)
     model.eval()
-    all_preds = []
-    all_targets = []
 
     with torch.no_grad():
         for t_run_hour, t_input, t_time, t_temp in dataloader:
-            t_run_hour = t_run_hour.to(DEVICE, non_blocking=True)
-            t_input = t_input.to(DEVICE, non_blocking=True)
-            t_time = t_time.to(DEVICE, non_blocking=True)
+            t_run_hour = t_run_hour.to(device, non_blocking=True)
+            t_input = t_input.to(device, non_blocking=True)
+            t_time = t_time.to(device, non_blocking=True)
 
-            with torch.amp.autocast('cuda'):
+            with autocast(device, enabled=amp):
                 preds = model(t_run_hour, t_input, t_time)
 
-            all_preds.extend(preds.cpu().numpy().flatten())
-            all_targets.extend(t_temp.numpy().flatten())
+            yield preds.float().cpu(), t_temp.cpu()
+
 
-    return np.array(all_preds), np.array(all_targets)
+def eval_model(model, dataloader, amp=True):
+    # Outputs are written into buffers sized from the dataset instead of growing per batch
+    targets = dataloader.data_tensors[-1]
+    all_preds = torch.empty(targets.shape, dtype=torch.float32)
+    all_targets = torch.empty(targets.shape, dtype=torch.float32)
+
+    offset = 0
+    for preds, t_temp in eval_batches(model, dataloader, amp):
+        all_preds[offset:offset + len(preds)] = preds
+        all_targets[offset:offset + len(preds)] = t_temp
+        offset += len(preds)
+
+    return all_preds.numpy().ravel(), all_targets.numpy().ravel()
+
+
+def eval_metrics(model, dataloader, amp=True):
+    metrics = MetricsAccumulator(dataloader.data_tensors[-1].size(1))
+    for preds, t_temp in eval_batches(model, dataloader, amp):
+        metrics.update(preds, t_temp)
+    return metrics.metrics()
 
 
 def validate_model(model, dataloader, criterion):
+    device = model_device(model)
     model.eval()
     total_loss = 0
     num_batches = 0
 
     with torch.no_grad():
         for t_run_hour, t_input, t_time, t_temp in dataloader:
-            t_run_hour = t_run_hour.to(DEVICE, non_blocking=True)
-            t_input = t_input.to(DEVICE, non_blocking=True)
-            t_time = t_time.to(DEVICE, non_blocking=True)
-            t_temp = t_temp.to(DEVICE, non_blocking=True)
+            t_run_hour = t_run_hour.to(device, non_blocking=True)
+            t_input = t_input.to(device, non_blocking=True)
+            t_time = t_time.to(device, non_blocking=True)
+            t_temp = t_temp.to(device, non_blocking=True)
 
-            with torch.amp.autocast('cuda'):
+            with autocast(device):
                 preds = model(t_run_hour, t_input, t_time)
                 loss = criterion(preds, t_temp)
 
@@ -81,59 +420,84 @@ def validate_model(model, dataloader, criterion):
     return avg_loss
 
 
-def final_eval(model, train_dataset, validation_dataset):
-    train_preds, train_targets = eval_model(model, train_dataset)
-    test_preds, test_targets = eval_model(model, validation_dataset)
-
-    train_mae = mean_absolute_error(train_targets, train_preds)
-    train_r2 = r2_score(train_targets, train_preds)
-    test_mae = mean_absolute_error(test_targets, test_preds)
-    test_r2 = r2_score(test_targets, test_preds)
+def final_eval(model, train_dataset, validation_dataset, model_file=MODEL_FILE, evaluate=eval_metrics):
+    train_metrics = evaluate(model, train_dataset)
+    test_metrics = evaluate(model, validation_dataset)
 
     print_log(f"Training Performance:", Fore.YELLOW)
-    print_log(f"  MAE: {train_mae:.4f}", Fore.CYAN)
-    print_log(f"  R²: {train_r2:.4f}", Fore.CYAN)
+    print_log(f"  MAE: {train_metrics['mae']:.4f}", Fore.CYAN)
+    print_log(f"  R²: {train_metrics['r2']:.4f}", Fore.CYAN)
 
     print_log(f"Testing Performance:", Fore.YELLOW)
-    print_log(f"  MAE: {test_mae:.4f}", Fore.CYAN)
-    print_log(f"  R²: {test_r2:.4f}", Fore.CYAN)
+    print_log(f"  MAE: {test_metrics['mae']:.4f}", Fore.CYAN)
+    print_log(f"  R²: {test_metrics['r2']:.4f}", Fore.CYAN)
+
+    if model_file:
+        torch.save(model.state_dict(), model_file)
+
+    return {
+        'train_mae': train_metrics['mae'],
+        'train_r2': train_metrics['r2'],
+        'val_mae': test_metrics['mae'],
+        'val_r2': test_metrics['r2'],
+    }
+
+
+def feature_sizes(features):
+    return {
+        'ukmo_var_size': features['input'].shape[2],
+        'run_enc_size': features['run_hour'].shape[1],
+        'fcst_enc_size': features['time'].shape[2],
+        'fcst_steps': features['time'].shape[1],
+    }
+
+
+@traced
+def prep_datasets(features, indices):
+    # Final (N, ...) tensors are allocated once and filled chunk by chunk straight from the feature arrays
+    prep_tensors = []
+
+    for name in DATASET_FIELDS:
+        feature = features[name]
+        tensor = torch.empty((len(indices), *feature.shape[1:]), dtype=torch.float32)
+
+        for start in range(0, len(indices), PREP_CHUNK):
+            rows = indices[start:start + PREP_CHUNK]
+            tensor[start:start + len(rows)] = torch.from_numpy(np.ascontiguousarray(feature[rows], dtype=np.float32))
+
+        prep_tensors.append(tensor)
 
-    torch.save(model.state_dict(), MODEL_FILE)
+    return tuple(prep_tensors)
 
 
-def prep_datasets(prep_data):
-    prep_samples = []
+# Shuffled batches gathered with one index per step, replaces a DataLoader over tensors that are already in memory
+class BatchIterator:
 
-    for entry in prep_data:
-        t_run_hour = torch.tensor(entry['run_hour'], dtype=torch.float32)
-        t_input = torch.tensor(entry['input'], dtype=torch.float32)
+    def __init__(self, data_tensors, batch_size, shuffle, device=None):
+        if device is not None:
+            data_tensors = tuple(tensor.to(device) for tensor in data_tensors)
 
-        temp_time = []
-        temp_temp = []
+        self.data_tensors = data_tensors
+        self.batch_size = batch_size
+        self.shuffle = shuffle
 
-        for item in entry['output']:
-            temp_time.append(item['time'])
-            temp_temp.append(item['temp'])
+    def __len__(self):
+        return math.ceil(len(self.data_tensors[0]) / self.batch_size)
 
-        t_time = torch.tensor(temp_time, dtype=torch.float32)
-        t_temp = torch.tensor(temp_temp, dtype=torch.float32)
+    def __iter__(self):
+        num_samples = len(self.data_tensors[0])
 
-        prep_samples.append((t_run_hour, t_input, t_time, t_temp))
+        if not self.shuffle:
+            for start in range(0, num_samples, self.batch_size):
+                yield tuple(tensor[start:start + self.batch_size] for tensor in self.data_tensors)
+            return
 
-    return prep_samples
+        order = torch.randperm(num_samples, device=self.data_tensors[0].device)
 
+        for start in range(0, num_samples, self.batch_size):
+            index = order[start:start + self.batch_size]
+            yield tuple(tensor.index_select(0, index) for tensor in self.data_tensors)
 
-def create_dataset(data_samples):
-    t_run_hours = torch.stack([sample[0] for sample in data_samples])
-    t_inputs = torch.stack([sample[1] for sample in data_samples])
-    t_times = torch.stack([sample[2] for sample in data_samples])
-    t_temps = torch.stack([sample[3] for sample in data_samples])
 
-    dataset = torch.utils.data.TensorDataset(t_run_hours, t_inputs, t_times, t_temps)
-    return torch.utils.data.DataLoader(dataset,
-                                       batch_size=128,
-                                       shuffle=True,
-                                       pin_memory=True,
-                                       num_workers=os.cpu_count(),
-                                       persistent_workers=True,
-                                       prefetch_factor=4)
+def create_dataset(data_tensors, shuffle=True, device=None):
+    return BatchIterator(data_tensors, batch_size=BATCH_SIZE, shuffle=shuffle, device=device)
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+
+import sys
+import csv
+import time
+import random
+import argparse
+import itertools
+import torch
+import numpy as np
+import torch.multiprocessing as mp
+from pathlib import Path
+from colorama import Fore
+
+sys.path.append(str(Path(__file__).parent.parent))
+from common.config import *
+from common.utility import *
+from model.support import *
+from model.transformer import *
+from model.main import prepare_data
+
+SWEEP_FILE = f"{DOWNLOAD_DIR}/sweep.csv"
+
+SWEEP_SPACE = {
+    'd_model': [128, 256],
+    'nhead': [4, 8],
+    'enc_layers': [4, 6],
+    'dec_layers': [2, 4],
+    'learning_rate': [1e-4, 3e-4],
+}
+
+# Median stopping rule: past the warm-up, a trial whose best val loss so far is worse than
+# the median of the other trials at the same epoch is stopped
+PRUNE_WARMUP = 10
+PRUNE_MIN_TRIALS = 3
+
+
+def sweep_trials(count, seed):
+    grid = [dict(zip(SWEEP_SPACE, values)) for values in itertools.product(*SWEEP_SPACE.values())]
+    random.Random(seed).shuffle(grid)
+    return grid[:count] if count else grid
+
+
+def init_sweep_worker(data, sizes, curves, settings):
+    global sweep_data, sweep_sizes, sweep_curves, sweep_settings
+    sweep_data, sweep_sizes, sweep_curves, sweep_settings = data, sizes, curves, settings
+
+    configure_cpu_threads(settings['threads'])
+
+
+def should_prune(trial_id, epoch):
+    curves = dict(sweep_curves.items())
+    others = [curve[epoch] for other_id, curve in curves.items() if other_id != trial_id and len(curve) > epoch]
+
+    if epoch + 1 < PRUNE_WARMUP or len(others) < PRUNE_MIN_TRIALS:
+        return False
+    return curves[trial_id][epoch] > np.median(others)
+
+
+def run_trial(trial):
+    trial_id, config = trial
+    torch.manual_seed(sweep_settings['seed'])
+
+    model_params = {**MODEL_PARAMS, **{name: value for name, value in config.items() if name in MODEL_PARAMS}}
+    model = build_model(sweep_sizes, model_params)
+
+    train_dataset = create_dataset(sweep_data['train'])
+    eval_dataset = create_dataset(sweep_data['eval'], shuffle=False)
+
+    best_curve = []
+    pruned = False
+
+    def on_epoch(epoch, val_loss):
+        nonlocal pruned
+        best_curve.append(min(val_loss, best_curve[-1]) if best_curve else val_loss)
+        sweep_curves[trial_id] = list(best_curve)
+
+        pruned = should_prune(trial_id, epoch)
+        return pruned
+
+    params = {
+        **TRAIN_PARAMS,
+        'learning_rate': config.get('learning_rate', TRAIN_PARAMS['learning_rate']),
+        'epochs': sweep_settings['epochs'],
+        'model_file': None,
+        'on_epoch': on_epoch,
+    }
+
+    print_log_p(f"Trial {trial_id}: {config}", Fore.YELLOW)
+    start = time.perf_counter()
+    result = train_model(model, train_dataset, eval_dataset, params)
+
+    return {'trial': trial_id, **config, **result, 'pruned': pruned, 'minutes': (time.perf_counter() - start) / 60}
+
+
+def write_results(results):
+    Path(SWEEP_FILE).parent.mkdir(parents=True, exist_ok=True)
+
+    with open(SWEEP_FILE, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(results[0]))
+        writer.writeheader()
+        writer.writerows(sorted(results, key=lambda result: result['trial']))
+
+
+def print_results(results):
+    print_log("\nSweep results (best first):", Fore.YELLOW)
+    header = f"{'Trial':>5} " + " ".join(f"{name:>13}" for name in SWEEP_SPACE)
+    header += f" {'Epochs':>6} {'Val loss':>9} {'Val MAE':>8} {'Val R²':>7} {'Pruned':>6} {'Minutes':>7}"
+    print_log(header, Fore.MAGENTA)
+
+    for result in sorted(results, key=lambda result: result['val_loss']):
+        row = f"{result['trial']:>5} " + " ".join(f"{result[name]:>13}" for name in SWEEP_SPACE)
+        print_log(
+            f"{row} {result['epochs']:>6} {result['val_loss']:>9.4f} {result['val_mae']:>8.4f} {result['val_r2']:>7.4f} "
+            f"{str(result['pruned']):>6} {result['minutes']:>7.1f}", Fore.GREEN)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Hyperparameter sweep over one prepared dataset")
+    parser.add_argument('--trials', type=int, default=0, help="number of grid points to try (default: whole grid)")
+    parser.add_argument('--workers', type=int, default=None, help="trials trained in parallel (default: cores / 4)")
+    parser.add_argument('--threads', type=int, default=None, help="CPU threads per trial (default: cores / workers)")
+    parser.add_argument('--epochs', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    workers, threads = plan_workers(args.workers or max(1, cpu_budget() // 4), args.threads, TRAIN_MEMORY)
+    print_plan("Sweep", workers, threads)
+
+    features = prepare_data(generate_runs())
+    train_data, eval_data = split_indices(features)
+
+    # Prepared once, every trial process maps the same shared memory
+    data = {'train': prep_datasets(features, train_data), 'eval': prep_datasets(features, eval_data)}
+    for tensors in data.values():
+        for tensor in tensors:
+            tensor.share_memory_()
+
+    trials = sweep_trials(args.trials, args.seed)
+    settings = {'epochs': args.epochs, 'threads': threads, 'seed': args.seed}
+    print_log(f"Running {len(trials)} trials on {workers} workers with {threads} threads each", Fore.CYAN)
+
+    # Spawned trials size their BLAS/OpenMP pools from the environment at start-up
+    set_thread_env(threads)
+
+    results = []
+    context = mp.get_context('spawn')
+
+    with context.Manager() as manager:
+        curves = manager.dict()
+        initargs = (data, feature_sizes(features), curves, settings)
+
+        with context.Pool(processes=workers, initializer=init_sweep_worker, initargs=initargs) as pool:
+            for result in pool.imap_unordered(run_trial, enumerate(trials)):
+                results.append(result)
+
+                # Rewritten after every trial so an interrupted sweep keeps what finished
+                write_results(results)
+                print_log_p(f"Trial {result['trial']} finished: val loss {result['val_loss']:.4f}", Fore.GREEN)
+
+    print_results(results)
+    print_log(f"Saved sweep results to {SWEEP_FILE}", Fore.GREEN)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+import csv
+import sys
+from metar import Metar
+from pathlib import Path
+from colorama import Fore
+from datetime import datetime, timedelta
+
+sys.path.append(str(Path(__file__).parent.parent))
+from common.config import *
+from common.utility import *
+from common.tracing import *
+from model.transform import FORECAST_PADDING, FORECAST_FRAME
+
+
+@traced
+def load_metar(metar_file):
+    import pandas as pd
+
+    metar_data = []
+
+    try:
+        with open(metar_file, 'r') as f:
+            reader = csv.DictReader(f)
+            for row in reader:
+                valid_dt = datetime.strptime(row['valid'], '%Y-%m-%d %H:%M')
+                metar_data.append({'datetime': valid_dt, 'metar': row['metar']})
+    except FileNotFoundError:
+        print_log(f"Error: CSV file not found: {metar_file}", Fore.RED)
+        sys.exit(1)
+
+    metar_df = pd.DataFrame(metar_data)
+    metar_df.set_index('datetime', inplace=True)
+    metar_df.sort_index(inplace=True)
+    return metar_df
+
+
+def get_metar_records(run, metar_data):
+    dt = parse_run_time(run)
+
+    start = dt
+
+    # off-by-one bug here but needed - if start is 03:00 and ends at 14:00
+    # we miss the 14:50 report, so we extend to 15:00
+    end = dt + timedelta(hours=FORECAST_HOURS)
+
+    return metar_data.loc[start:end]
+
+
+def parse_metar(records):
+    run_metar_data = []
+
+    for dt_val, row in records.iterrows():
+        # Provide month and year context to prevent day 31 parsing errors
+        obs = Metar.Metar(row['metar'], month=dt_val.month, year=dt_val.year)
+        if obs.temp:
+            run_metar_data.append({'datetime': dt_val, 'temp': obs.temp.value()})
+
+    return run_metar_data
+
+
+@traced
+def get_metar(run, metar_data):
+    return parse_metar(get_metar_records(run, metar_data))
+
+
+def filter_metar(run, run_metar_data):
+    filter_metar_data = []
+
+    run_dt = parse_run_time(run)
+    init_time = run_dt + timedelta(hours=FORECAST_PADDING)
+    cutoff_time = run_dt + timedelta(hours=FORECAST_FRAME)
+
+    # Remove first and last hour from METAR reports
+    # Filter out reports if they are not from xx:20 or xx:50
+    for metar_data in run_metar_data:
+        if metar_data['datetime'].minute in [20, 50]:
+            if init_time <= metar_data['datetime'] <= cutoff_time:
+                filter_metar_data.append(metar_data)
+
+    return filter_metar_data
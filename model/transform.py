@@ -1,15 +1,13 @@
-import os
 import sys
-import calendar
 import numpy as np
 from pathlib import Path
 from colorama import Fore
-from multiprocessing import Pool
-from datetime import datetime, timedelta
+from datetime import timedelta
 
 sys.path.append(str(Path(__file__).parent.parent))
 from common.config import *
 from common.utility import *
+from model.encoding import *
 
 FORECAST_PADDING = 1
 FORECAST_FRAME = 15
@@ -19,158 +17,161 @@ def is_invalid(value):
     return value == DEFAULT_VALUE
 
 
-def weeks_in_year(year):
-    # Dec 28 is always in the last week of the year
-    dec_28 = datetime(year, 12, 28)
-    return dec_28.isocalendar()[1]
+def round_2(values):
+    # Same result as Python's round(x, 2), np.round only differs for values sitting close to a half-way point
+    scaled = values * 100
+    rounded = np.round(scaled) / 100
 
+    near_half = np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6
+    if near_half.any():
+        rounded[near_half] = [round(float(value), 2) for value in values[near_half]]
+    return rounded
 
-def cyclical_encode(value, max_value):
-    angle = 2 * np.pi * value / max_value
-    return np.sin(angle), np.cos(angle)
 
+def column(raw, field):
+    return raw[..., COLUMN_PROCESS.index(field)]
 
-def cyclical_encode_week(date_str):
-    dt = datetime.strptime(date_str, '%Y%m%d')
-    week = dt.isocalendar()[1]
-    total_weeks = weeks_in_year(dt.year)
-    return cyclical_encode(week, total_weeks)
 
+def cyclical_encode_week(date):
+    week = encode_week(*date_to_week(date))
+    return week[..., 0], week[..., 1]
 
-def cyclical_encode_hour(hour_str):
-    dt = datetime.strptime(hour_str, '%H%M')
-    hour_decimal = dt.hour + dt.minute / 60
-    return cyclical_encode(hour_decimal, 24)
+
+def cyclical_encode_hour(hour):
+    hour = encode_minute(hhmm_to_minute(hour))
+    return hour[..., 0], hour[..., 1]
 
 
 def cyclical_encode_direction(wind_dir):
-    if is_invalid(wind_dir):
-        return DEFAULT_VALUE, DEFAULT_VALUE
-    return cyclical_encode(wind_dir, 360)
+    invalid = is_invalid(wind_dir)
+    wind_dir_sin, wind_dir_cos = cyclical_encode(wind_dir, 360)
+    return np.where(invalid, DEFAULT_VALUE, wind_dir_sin), np.where(invalid, DEFAULT_VALUE, wind_dir_cos)
 
 
 def kelvin_to_celsius(kelvin):
-    if is_invalid(kelvin):
-        return DEFAULT_VALUE
-    return round(kelvin - 273.15, 2)
+    return np.where(is_invalid(kelvin), DEFAULT_VALUE, round_2(kelvin - 273.15))
 
 
 def relative_humidity(temp, temp_dew):
-    if is_invalid(temp) or is_invalid(temp_dew):
-        return DEFAULT_VALUE
+    invalid = is_invalid(temp) | is_invalid(temp_dew)
 
     exp_dew = np.exp((17.625 * temp_dew) / (243.04 + temp_dew))
     exp_temp = np.exp((17.625 * temp) / (243.04 + temp))
-    return round(100 * exp_dew / exp_temp, 2)
+    return np.where(invalid, DEFAULT_VALUE, round_2(100 * exp_dew / exp_temp))
 
 
 def mps_to_knots(mps):
-    if is_invalid(mps):
-        return DEFAULT_VALUE
-    return round(mps * 1.94384, 2)
+    return np.where(is_invalid(mps), DEFAULT_VALUE, round_2(mps * 1.94384))
 
 
 def fraction_to_percent(fraction):
-    if is_invalid(fraction):
-        return DEFAULT_VALUE
-    return round(fraction * 100, 2)
+    return np.where(is_invalid(fraction), DEFAULT_VALUE, round_2(fraction * 100))
 
 
 def pascal_to_hpa(pascal):
-    if is_invalid(pascal):
-        return DEFAULT_VALUE
-    return round(pascal / 100, 2)
-
-
-def transform_row(row):
-    week_sin, week_cos = cyclical_encode_week(row['date'])
-    hour_sin, hour_cos = cyclical_encode_hour(row['hour'])
+    return np.where(is_invalid(pascal), DEFAULT_VALUE, round_2(pascal / 100))
 
-    temp = kelvin_to_celsius(float(row['temp']))
-    temp_min = kelvin_to_celsius(float(row['temp_min']))
-    temp_max = kelvin_to_celsius(float(row['temp_max']))
-    temp_dew = kelvin_to_celsius(float(row['temp_dew']))
-    temp_surf = kelvin_to_celsius(float(row['temp_surf']))
 
-    humidity_rel = relative_humidity(temp, temp_dew)
+def transform_input(raw):
+    # raw: (..., hours, COLUMN_PROCESS) float64, returns (..., hours, COLUMN_TRANSFORM)
+    week_sin, week_cos = cyclical_encode_week(column(raw, 'date'))
+    hour_sin, hour_cos = cyclical_encode_hour(column(raw, 'hour'))
 
-    wind_speed = mps_to_knots(float(row['wind_speed']))
+    temp = kelvin_to_celsius(column(raw, 'temp'))
+    temp_dew = kelvin_to_celsius(column(raw, 'temp_dew'))
 
-    wind_dir_sin, wind_dir_cos = cyclical_encode_direction(float(row['wind_dir']))
+    wind_dir_sin, wind_dir_cos = cyclical_encode_direction(column(raw, 'wind_dir'))
 
-    cloud_low = fraction_to_percent(float(row['cloud_low']))
-    cloud_medium = fraction_to_percent(float(row['cloud_medium']))
-
-    sea_press = pascal_to_hpa(float(row['sea_press']))
-
-    return {
+    features = {
         'week_sin': week_sin,
         'week_cos': week_cos,
         'hour_sin': hour_sin,
         'hour_cos': hour_cos,
         'temp': temp,
-        'temp_min': temp_min,
-        'temp_max': temp_max,
+        'temp_min': kelvin_to_celsius(column(raw, 'temp_min')),
+        'temp_max': kelvin_to_celsius(column(raw, 'temp_max')),
         'temp_dew': temp_dew,
-        'temp_surf': temp_surf,
-        'humidity_rel': humidity_rel,
-        'wind_speed': wind_speed,
+        'temp_surf': kelvin_to_celsius(column(raw, 'temp_surf')),
+        'humidity_rel': relative_humidity(temp, temp_dew),
+        'wind_speed': mps_to_knots(column(raw, 'wind_speed')),
         'wind_dir_sin': wind_dir_sin,
         'wind_dir_cos': wind_dir_cos,
-        'cloud_low': cloud_low,
-        'cloud_medium': cloud_medium,
-        'sea_press': sea_press,
-        'rad_sw_dir_down': round(float(row['rad_sw_dir_down']), 2),
-        'rad_lw_down': round(float(row['rad_lw_down']), 2),
-        'heat_flux': round(float(row['heat_flux']), 2),
+        'cloud_low': fraction_to_percent(column(raw, 'cloud_low')),
+        'cloud_medium': fraction_to_percent(column(raw, 'cloud_medium')),
+        'precip_accum': round_2(column(raw, 'precip_accum')),
+        'sea_press': pascal_to_hpa(column(raw, 'sea_press')),
+        'rad_sw_dir_down': round_2(column(raw, 'rad_sw_dir_down')),
+        'rad_sw_total_down': round_2(column(raw, 'rad_sw_total_down')),
+        'rad_lw_down': round_2(column(raw, 'rad_lw_down')),
+        'heat_flux': round_2(column(raw, 'heat_flux')),
     }
 
+    return np.stack([features[field] for field in COLUMN_TRANSFORM], axis=-1)
 
-def transform_run(run):
-    run_dt = parse_run_time(run['run_id'])
-    csv_data = run['csv_data']
-    metar_data = run['metar_data']
 
-    run_hour_sin, run_hour_cos = cyclical_encode_hour(run_dt.strftime('%H%M'))
-    run_hour = [run_hour_sin, run_hour_cos]
+def get_raw(csv_data):
+    return [[float(row[field]) for field in COLUMN_PROCESS] for row in csv_data]
 
-    input = []
-    for row in csv_data:
-        c_row = []
-        t_row = transform_row(row)
 
-        for field in COLUMN_TRANSFORM:
-            c_row.append(t_row[field])
+def transform_output(metar_data):
+    minutes = np.array([datetime_to_minute(metar['datetime']) for metar in metar_data], dtype=np.int64)
+    temps = np.array([metar['temp'] for metar in metar_data], dtype=np.float64)
 
-        input.append(c_row)
+    return encode_minute(minutes), temps
 
-    output = []
-    for metar in metar_data:
-        metar_dt = metar['datetime']
 
-        metar_hour_sin, metar_hour_cos = cyclical_encode_hour(metar_dt.strftime('%H%M'))
-        metar_hour = [metar_hour_sin, metar_hour_cos]
+def forecast_times(run):
+    # Hourly xx:50 reports between the padding hour and the end of the frame, the observations the model is trained on
+    run_dt = parse_run_time(run)
+    return [run_dt + timedelta(hours=hour, minutes=50) for hour in range(FORECAST_PADDING, FORECAST_FRAME)]
 
-        output.append({'time': metar_hour, 'temp': metar['temp']})
 
-    if len(output) != (FORECAST_FRAME - FORECAST_PADDING):
-        return {}
-
-    transformed_data = {'run_hour': run_hour, 'input': input, 'output': output}
-    return transformed_data
+def transform_runs(runs, raws, times):
+    # Features of runs without METAR data, for predicting at `times` (one list of forecast times per run)
+    run_minutes = np.array([datetime_to_minute(parse_run_time(run)) for run in runs], dtype=np.int64)
+    minutes = np.array([[datetime_to_minute(dt) for dt in run_times] for run_times in times], dtype=np.int64)
 
+    return {
+        'run_hour': encode_minute(run_minutes),
+        'input': transform_input(np.stack(raws)),
+        'time': encode_minute(minutes),
+    }
 
-def transform(run_data):
-    transformed_data = []
 
-    num_cores = os.cpu_count()
-    print_log(f"Using {num_cores} CPU cores for parallel transform processing")
+def transform_run(run, raw, times):
+    features = transform_runs([run], [raw], [times])
+    return {name: feature[0] for name, feature in features.items()}
 
-    with Pool(processes=num_cores) as pool:
-        run_results = pool.map(transform_run, run_data)
 
-    for run_result in run_results:
-        if run_result:
-            transformed_data.append(run_result)
+def transform(run_data):
+    # run_data: [(run_id, raw (hours, COLUMN_PROCESS), metar_data)], runs without a full set of METAR reports are dropped
+    run_ids = []
+    run_minutes = []
+    raws = []
+    times = []
+    temps = []
+
+    for run_id, raw, metar_data in run_data:
+        if len(metar_data) != (FORECAST_FRAME - FORECAST_PADDING):
+            continue
+
+        time, temp = transform_output(metar_data)
+
+        run_ids.append(run_id)
+        run_minutes.append(datetime_to_minute(parse_run_time(run_id)))
+        raws.append(raw)
+        times.append(time)
+        temps.append(temp)
+
+    if not run_ids:
+        return run_ids, {}
+
+    # Whole chunk in one pass: (runs, hours, COLUMN_PROCESS) -> (runs, hours, COLUMN_TRANSFORM)
+    features = {
+        'run_hour': encode_minute(np.array(run_minutes, dtype=np.int64)),
+        'input': transform_input(np.stack(raws)),
+        'time': np.stack(times),
+        'temp': np.stack(temps),
+    }
 
-    return transformed_data
+    return run_ids, features
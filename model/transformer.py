@@ -1,9 +1,13 @@
+import io
 import os
+import copy
 import sys
 import math
+import time
 import torch
 import torch.nn as nn
 import torch.optim as optim
+import numpy as np
 from pathlib import Path
 from colorama import Fore
 from sklearn.model_selection import train_test_split
@@ -12,6 +16,8 @@ from sklearn.metrics import mean_absolute_error, r2_score
 sys.path.append(str(Path(__file__).parent.parent))
 from common.utility import *
 from model.support import *
+from model.lineage import *
+from model.store import FEATURE_SHAPES
 
 
 # https://docs.pytorch.org/docs/stable/generated/torch.nn.TransformerEncoderLayer.html
@@ -40,7 +46,7 @@ class WeatherEncoder(nn.Module):
 
 
 # https://docs.pytorch.org/docs/stable/generated/torch.nn.TransformerDecoderLayer.html
-# Implements smooth rounding from https://arxiv.org/abs/2504.19026
+# Implements smooth rounding from https://arxiv.org/abs/2504.19026 (see SmoothRound)
 class TemperatureDecoder(nn.Module):
 
     def __init__(self, run_enc_size, fcst_enc_size, fcst_steps, d_model, nhead, num_layers, dim_feedforward, dropout):
@@ -60,28 +66,19 @@ class TemperatureDecoder(nn.Module):
         self.transformer = nn.TransformerDecoder(decoder_layer, num_layers)
         self.output_proj = nn.Linear(d_model, 1)
 
-    def sigmoid(self, z):
-        return 1 / (1 + torch.exp(-z))
-
-    def smooth_round_sigma(self, x, k):
-        result = torch.zeros_like(x)
-
-        # Get range of integers to consider (5 neighbors for efficiency)
-        x_floor = torch.floor(x)
-
-        for offset in range(-2, 3):  # n in [floor(x)-2, floor(x)+2]
-            n = x_floor + offset
+        # Ensures autoregressive training: each timestep can only attend to previous timesteps
+        self.register_buffer('tgt_mask', nn.Transformer.generate_square_subsequent_mask(fcst_steps), persistent=False)
 
-            # Sigmoid window: σ(k(x-(n-0.5))) - σ(k(x-(n+0.5)))
-            sig_left = self.sigmoid(k * (x - (n - 0.5)))
-            sig_right = self.sigmoid(k * (x - (n + 0.5)))
-            window = sig_left - sig_right
+        # Rounding sharpness lives in a buffer so a compiled graph does not specialize on every epoch's value
+        self.register_buffer('train_k', torch.tensor(5.0), persistent=False)
 
-            result += n * window
+    def set_epoch(self, epoch, max_epochs):
+        self.train_k.fill_(rounding_k(epoch, max_epochs))
 
-        return result
+    def smooth_round_sigma(self, x, k):
+        return SmoothRound.apply(x, k)
 
-    def forward(self, enc_output, t_run_hour, t_time, epoch=None, max_epochs=None):
+    def forward(self, enc_output, t_run_hour, t_time):
         # Broadcast model run encoding to all fcst timesteps
         run_enc_expand = t_run_hour.unsqueeze(1).repeat(1, self.fcst_steps, 1)
 
@@ -91,20 +88,15 @@ class TemperatureDecoder(nn.Module):
         decoder_input = self.pos_encoding(decoder_input)
         decoder_input = self.dropout(decoder_input)
 
-        # Ensures autoregressive training: each timestep can only attend to previous timesteps
-        tgt_mask = nn.Transformer.generate_square_subsequent_mask(decoder_input.size(1)).to(decoder_input.device)
-
         # Cross-attention: time queries attend to weather history with causal masking
-        output = self.transformer(decoder_input, enc_output, tgt_mask=tgt_mask)
+        output = self.transformer(decoder_input, enc_output, tgt_mask=self.tgt_mask, tgt_is_causal=True)
 
         # Project to temperature values and remove singleton dimension
-        temps = self.output_proj(output).squeeze(-1)
+        # Rounding runs in float32, bfloat16 autocast cannot resolve fractions of a degree
+        temps = self.output_proj(output).squeeze(-1).float()
 
         if self.training:
-            # Reach k=20 by 1/2 of training (before typical early stopping)
-            target_epoch = max_epochs // 2
-            progress = min(epoch / target_epoch, 1.0)
-            k = 5 + progress * 15  # k: 5→20
+            k = self.train_k
         else:
             # Fixed k=15 for validation/testing (middle ground sharpness)
             k = 15
@@ -121,45 +113,119 @@ class WeatherModel(nn.Module):
         self.decoder = TemperatureDecoder(run_enc_size, fcst_enc_size, fcst_steps, d_model, nhead, dec_layers, dim_feedforward,
                                           dropout)
 
-    def forward(self, t_run_hour, t_input, t_time, epoch=None, max_epochs=None):
+    def set_epoch(self, epoch, max_epochs):
+        self.decoder.set_epoch(epoch, max_epochs)
+
+    def forward(self, t_run_hour, t_input, t_time):
         enc_output = self.encoder(t_input)
-        return self.decoder(enc_output, t_run_hour, t_time, epoch, max_epochs)
+        return self.decoder(enc_output, t_run_hour, t_time)
 
 
-def train_model(model, train_dataset, validation_dataset, params):
-    criterion = nn.MSELoss()
-    scaler = torch.amp.GradScaler('cuda')
-    optimizer = optim.AdamW(model.parameters(), lr=params['learning_rate'], weight_decay=params['l2_reg_weight'])
-    scheduler = optim.lr_scheduler.ReduceLROnPlateau(optimizer, mode='min', factor=0.5, patience=15, min_lr=1e-6)
+# Attention-free student: the whole input window is flattened into one context vector, each forecast step
+# is read out from that context plus its run and time encodings
+class WeatherMLP(nn.Module):
 
-    epochs = params['epochs']
-    model.to(DEVICE)
+    def __init__(self, ukmo_var_size, run_enc_size, fcst_enc_size, fcst_steps, hidden, layers, dropout):
+        super().__init__()
+        self.fcst_steps = fcst_steps
 
-    es_loss = float('inf')
-    es_counter = 0
-    es_patience = 50
-    es_model_state = None
+        history = []
+        in_size = FEATURE_SHAPES['input'][0] * ukmo_var_size
+        for _ in range(layers):
+            history += [nn.Linear(in_size, hidden), nn.GELU(), nn.Dropout(dropout)]
+            in_size = hidden
+        self.history = nn.Sequential(*history)
+
+        self.head = nn.Sequential(nn.Linear(hidden + run_enc_size + fcst_enc_size, hidden), nn.GELU(), nn.Linear(hidden, 1))
 
-    for epoch in range(epochs):
-        model.train()
-        epoch_loss = 0
-        num_batches = 0
+        # Same rounding schedule as TemperatureDecoder
+        self.register_buffer('train_k', torch.tensor(5.0), persistent=False)
 
-        for t_run_hour, t_input, t_time, t_temp in train_dataset:
-            t_run_hour = t_run_hour.to(DEVICE, non_blocking=True)
-            t_input = t_input.to(DEVICE, non_blocking=True)
-            t_time = t_time.to(DEVICE, non_blocking=True)
-            t_temp = t_temp.to(DEVICE, non_blocking=True)
+    def set_epoch(self, epoch, max_epochs):
+        self.train_k.fill_(rounding_k(epoch, max_epochs))
 
-            optimizer.zero_grad()
+    def forward(self, t_run_hour, t_input, t_time):
+        context = self.history(t_input.flatten(1))
+        context = torch.cat([context, t_run_hour], dim=1).unsqueeze(1).expand(-1, self.fcst_steps, -1)
+
+        temps = self.head(torch.cat([context, t_time], dim=2)).squeeze(-1).float()
+        return SmoothRound.apply(temps, self.train_k if self.training else 15)
+
+
+# Dynamic int8 for every nn.Linear (input/output projections and the feedforward blocks).
+# Quantized Linear layers hide their weight tensors, which the fused encoder fast path reads, so it is switched off.
+class QuantizedWeatherModel(nn.Module):
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = torch.ao.quantization.quantize_dynamic(model.to('cpu').eval(), {nn.Linear}, dtype=torch.qint8)
+
+    def forward(self, t_run_hour, t_input, t_time):
+        fastpath = torch.backends.mha.get_fastpath_enabled()
+        torch.backends.mha.set_fastpath_enabled(False)
+
+        try:
+            return self.model(t_run_hour, t_input, t_time)
+        finally:
+            torch.backends.mha.set_fastpath_enabled(fastpath)
+
+
+def build_model(sizes, model_params=MODEL_PARAMS):
+    if 'hidden' in model_params:
+        return WeatherMLP(**sizes, **model_params)
+    return WeatherModel(**sizes, **model_params)
+
+
+def split_indices(features):
+    indices = np.arange(len(features['run_id']))
+    return train_test_split(indices, test_size=0.1, random_state=69)
+
+
+def load_model(sizes, device, int8=False):
+    model = build_model(sizes)
+
+    if int8:
+        # Quantized weights only run on CPU
+        model = QuantizedWeatherModel(model)
+        model.load_state_dict(torch.load(QUANTIZED_FILE, map_location='cpu'))
+    else:
+        model.load_state_dict(torch.load(MODEL_FILE, map_location=device))
+        model.to(device)
+
+    model.eval()
+    return model
+
+
+def train_epoch(model, train_dataset, criterion, optimizer, scaler, timer, profiler):
+    device = model_device(model)
+    model.train()
+
+    epoch_loss = 0
+    num_batches = 0
+    num_samples = 0
+
+    batches = iter(train_dataset)
+    while True:
+        with timer.phase('data'):
+            batch = next(batches, None)
+        if batch is None:
+            break
 
-            # Mixed precision forward pass and loss calculation
-            with torch.amp.autocast('cuda'):
-                preds = model(t_run_hour, t_input, t_time, epoch=epoch, max_epochs=epochs)
-                loss = criterion(preds, t_temp)
+        with timer.phase('copy'):
+            t_run_hour, t_input, t_time, t_temp = [tensor.to(device, non_blocking=True) for tensor in batch]
 
-            # Backward pass: scale loss → compute gradients → unscale for clipping
+        optimizer.zero_grad()
+
+        # Mixed precision forward pass and loss calculation
+        with timer.phase('forward'), autocast(device):
+            preds = model(t_run_hour, t_input, t_time)
+            loss = criterion(preds, t_temp)
+
+        # Backward pass: scale loss → compute gradients → unscale for clipping
+        with timer.phase('backward'):
             scaler.scale(loss).backward()
+
+        with timer.phase('optimizer'):
             scaler.unscale_(optimizer)
 
             # Prevent gradient explosion by clipping gradient norm to 1.0
@@ -169,134 +235,400 @@ def train_model(model, train_dataset, validation_dataset, params):
             scaler.step(optimizer)
             scaler.update()
 
-            epoch_loss += loss.item()
-            num_batches += 1
+        epoch_loss += loss.item()
+        num_batches += 1
+        num_samples += t_temp.size(0)
+
+        if profiler:
+            profiler.step()
+
+    return epoch_loss / num_batches, num_samples
+
 
-        avg_loss = validate_model(model, validation_dataset, criterion)
+def train_model(model, train_dataset, validation_dataset, params):
+    criterion = nn.MSELoss()
+    device = model_device(model)
+    validate = params.get('validate', validate_model)
+
+    # Unwrapped model for state dicts and set_epoch when training under DistributedDataParallel
+    module = getattr(model, 'module', model)
+    scaler = grad_scaler(device)
+    optimizer = optim.AdamW(model.parameters(), lr=params['learning_rate'], weight_decay=params['l2_reg_weight'])
+    scheduler = optim.lr_scheduler.ReduceLROnPlateau(optimizer, mode='min', factor=0.5, patience=15, min_lr=1e-6)
+
+    epochs = params['epochs']
+
+    es_loss = float('inf')
+    es_counter = 0
+    es_patience = 50
+    es_model_state = None
+
+    start_epoch = 0
+    checkpoint_file = params.get('checkpoint')
+
+    # 'resume' is the checkpoint to continue from, 'checkpoint' where new ones are written
+    if params.get('resume'):
+        checkpoint = load_checkpoint(params['resume'])
+        module.load_state_dict(checkpoint['model'])
+        optimizer.load_state_dict(checkpoint['optimizer'])
+        scaler.load_state_dict(checkpoint['scaler'])
+        scheduler.load_state_dict(checkpoint['scheduler'])
+        es_loss, es_counter, es_model_state = checkpoint['es_loss'], checkpoint['es_counter'], checkpoint['es_model_state']
+        set_rng_state(device, checkpoint['rng'])
+
+        start_epoch = checkpoint['epoch'] + 1
+        print_log(f"Resuming from {params['resume']} at epoch {start_epoch + 1}, best val loss: {es_loss:.4f}", Fore.GREEN)
+
+    # Fine-tuning continues from the optimizer state the model was trained with, at a new learning rate
+    if params.get('warm_start'):
+        warm_start = load_checkpoint(params['warm_start'])
+        optimizer.load_state_dict(warm_start['optimizer'])
+        scaler.load_state_dict(warm_start['scaler'])
+        for group in optimizer.param_groups:
+            group['lr'] = params['learning_rate']
+
+    # Serialisation and disk writes happen on a background thread, training only waits for the CPU copy
+    writer = CheckpointWriter(checkpoint_file) if checkpoint_file else None
+
+    profile_start, profile_steps = params.get('profile', (0, 0))
+    timer = PhaseTimer(device, sync=profile_steps > 0)
+    profiler = training_profiler(device, profile_start, profile_steps)
+
+    epochs_done = start_epoch
+    for epoch in range(start_epoch, epochs):
+        epochs_done = epoch + 1
+        # 'final_k' keeps the rounding sharpness a trained model ended with instead of restarting its schedule
+        module.set_epoch(epochs if params.get('final_k') else epoch, epochs)
+        timer.reset()
+        reset_peak_memory(device)
+        epoch_start = time.perf_counter()
+
+        with span('train_epoch', epoch=epoch + 1):
+            train_loss, num_samples = train_epoch(model, train_dataset, criterion, optimizer, scaler, timer, profiler)
+        samples_per_sec = num_samples / (time.perf_counter() - epoch_start)
+
+        with timer.phase('validation'):
+            avg_loss = validate(model, validation_dataset, criterion)
         scheduler.step(avg_loss)
 
         if avg_loss < es_loss:
             es_loss = avg_loss
             es_counter = 0
-            es_model_state = model.state_dict()
+            es_model_state = snapshot(module.state_dict())
             print_log(f"New best model at epoch {epoch+1} with val loss: {es_loss:.4f}", Fore.GREEN)
         else:
             es_counter += 1
 
         if es_counter >= es_patience:
             print_log(f"Early stopping triggered at epoch {epoch+1}. Best val loss: {es_loss:.4f}", Fore.YELLOW)
-            model.load_state_dict(es_model_state)
+            module.load_state_dict(es_model_state)
+            break
+
+        # Optional per-epoch hook, returns True to stop this run (used by the sweep to prune trials)
+        if 'on_epoch' in params and params['on_epoch'](epoch, avg_loss):
+            print_log(f"Stopped at epoch {epoch+1} by on_epoch hook. Best val loss: {es_loss:.4f}", Fore.YELLOW)
             break
 
         if (epoch + 1) % 5 == 0:
-            train_loss = epoch_loss / num_batches
             current_lr = scheduler.get_last_lr()[0]
             print_log(
                 f"Epoch [{epoch+1}/{epochs}], Loss: {train_loss:.4f}, Val Loss: {avg_loss:.4f}, "
-                f"LR: {current_lr:.6f}, Patience: {es_counter}/{es_patience}", Fore.BLUE)
+                f"LR: {current_lr:.6f}, Patience: {es_counter}/{es_patience}, {samples_per_sec:.0f} samples/s", Fore.BLUE)
+            print_log(f"  Time: {timer.summary()}, peak memory: {peak_memory(device)}", Fore.BLUE)
+
+        if writer and (epoch + 1) % CHECKPOINT_EVERY == 0:
+            writer.save(
+                snapshot({
+                    'epoch': epoch,
+                    'model': module.state_dict(),
+                    'optimizer': optimizer.state_dict(),
+                    'scaler': scaler.state_dict(),
+                    'scheduler': scheduler.state_dict(),
+                    'es_loss': es_loss,
+                    'es_counter': es_counter,
+                    'es_model_state': es_model_state,
+                    'rng': rng_state(device),
+                }))
+
+    if profiler:
+        profiler.stop()
+    if writer:
+        writer.close()
 
     if es_model_state is not None and es_counter < es_patience:
         print_log(f"Loading best model with val loss: {es_loss:.4f}", Fore.GREEN)
-        model.load_state_dict(es_model_state)
+        module.load_state_dict(es_model_state)
 
-    final_eval(model, train_dataset, validation_dataset)
+    metrics = final_eval(module, train_dataset, validation_dataset, params.get('model_file', MODEL_FILE),
+                         params.get('evaluate', eval_metrics))
 
+    if params.get('optimizer_file'):
+        torch.save({'optimizer': optimizer.state_dict(), 'scaler': scaler.state_dict()}, params['optimizer_file'])
+    return {'val_loss': es_loss, 'epochs': epochs_done, **metrics}
 
-def train_transformer(training_data):
-    train_data, eval_data = train_test_split(training_data, test_size=0.1, random_state=69)
 
-    _train_data = prep_datasets(train_data)
-    train_dataset = create_dataset(_train_data)
-    print_log(f"Generated {len(_train_data)} training samples", Fore.BLUE)
+def train_transformer(features, device, compiled=False, profile=(0, 0), resume=False):
+    train_data, eval_data = split_indices(features)
 
-    _eval_data = prep_datasets(eval_data)
-    eval_dataset = create_dataset(_eval_data)
-    print_log(f"Generated {len(_eval_data)} evaluation samples", Fore.BLUE)
+    _train_data = prep_datasets(features, train_data)
+    train_dataset = create_dataset(_train_data, device=device)
+    print_log(f"Generated {len(train_data)} training samples", Fore.BLUE)
+
+    _eval_data = prep_datasets(features, eval_data)
+    eval_dataset = create_dataset(_eval_data, shuffle=False, device=device)
+    print_log(f"Generated {len(eval_data)} evaluation samples", Fore.BLUE)
 
     print_log(f"Split data: {len(train_data)} train, {len(eval_data)} eval samples", Fore.CYAN)
 
-    run_enc_size = len(train_data[0]['run_hour'])
-    ukmo_var_size = len(train_data[0]['input'][0])
-    fcst_steps = len(train_data[0]['output'])
-    fcst_enc_size = len(train_data[0]['output'][0]['time'])
+    model = build_model(feature_sizes(features))
+
+    print_log(f"Training Transformer model with params: {TRAIN_PARAMS}", Fore.YELLOW)
+    params = {
+        **TRAIN_PARAMS,
+        'profile': profile,
+        'checkpoint': CHECKPOINT_FILE,
+        'resume': CHECKPOINT_FILE if resume else None,
+        'optimizer_file': OPTIMIZER_FILE,
+    }
+    model.to(device)
+    if compiled:
+        compile_model(model)
+
+    result = train_model(model, train_dataset, eval_dataset, params)
+    record_version(MODEL_FILE, 'train', features['run_id'], features['run_id'], result)
+
+
+def finetune_transformer(features, device):
+    parent = latest_version(load_lineage())
+    if parent is None:
+        print_log(f"Error: no model lineage in {LINEAGE_FILE}, run a full train first", Fore.RED)
+        sys.exit(1)
+
+    # Runs the parent was not trained on, including ones backfilled before its latest run
+    run_ids = np.array(features['run_id'])
+    seen = version_runs(parent)
+    if seen is None:
+        seen = {run for run in run_ids if run <= parent['last_run']}
+    is_new = np.array([run not in seen for run in run_ids], dtype=bool)
+    new_data, old_data = np.flatnonzero(is_new), np.flatnonzero(~is_new)
+
+    if len(new_data) < FINETUNE_MIN_RUNS:
+        print_log(f"{len(new_data)} runs not seen by model version {parent['version']}, need {FINETUNE_MIN_RUNS} to fine-tune",
+                  Fore.GREEN)
+        return
+
+    # Held-out runs come from the new ones only, the parent has been trained on every replayed run
+    new_train, eval_data = train_test_split(new_data, test_size=0.1, random_state=69)
+
+    # New runs plus a replay sample of older ones so the model does not drift towards the latest weather
+    replay_size = min(len(old_data), REPLAY_RATIO * len(new_train))
+    replay_data = np.random.default_rng(parent['version']).choice(old_data, size=replay_size, replace=False)
+    train_data = np.concatenate([new_train, replay_data])
+    print_log(
+        f"Fine-tuning version {parent['version']} on {len(new_train)} new and {replay_size} replayed runs, "
+        f"{len(eval_data)} new runs held out", Fore.CYAN)
+
+    train_dataset = create_dataset(prep_datasets(features, train_data), device=device)
+    eval_dataset = create_dataset(prep_datasets(features, eval_data), shuffle=False, device=device)
+
+    model = load_model(feature_sizes(features), device)
+
+    before_mae = eval_metrics(model, eval_dataset)['mae']
+    print_log(f"Before fine-tuning, val MAE: {before_mae:.4f}", Fore.BLUE)
+
+    # The model and optimizer files are only replaced once the fine-tuned model has been compared with its parent
+    optimizer_tmp = f"{OPTIMIZER_FILE}.tmp"
+    params = {
+        **FINETUNE_PARAMS,
+        'final_k': True,
+        'warm_start': OPTIMIZER_FILE if Path(OPTIMIZER_FILE).exists() else None,
+        'model_file': None,
+        'optimizer_file': optimizer_tmp,
+    }
+    if params['warm_start'] is None:
+        print_log(f"No optimizer state in {OPTIMIZER_FILE}, starting with a fresh optimizer", Fore.YELLOW)
+
+    print_log(f"Fine-tuning Transformer model with params: {FINETUNE_PARAMS}", Fore.YELLOW)
+    result = train_model(model, train_dataset, eval_dataset, params)
+
+    if result['val_mae'] >= before_mae:
+        Path(optimizer_tmp).unlink(missing_ok=True)
+        print_log(
+            f"Fine-tuning did not improve val MAE ({before_mae:.4f} -> {result['val_mae']:.4f}), "
+            f"keeping model version {parent['version']}", Fore.YELLOW)
+        return
+
+    print_log(f"Fine-tuning improved val MAE {before_mae:.4f} -> {result['val_mae']:.4f}", Fore.GREEN)
+    torch.save(model.state_dict(), MODEL_FILE)
+    os.replace(optimizer_tmp, OPTIMIZER_FILE)
+    record_version(MODEL_FILE, 'finetune', run_ids[train_data].tolist(), run_ids[new_train].tolist(), result)
+
+
+def test_transformer(features, device, compiled=False, int8=False):
+    test_data = np.arange(len(features['run_id']))
+    test_dataset = create_dataset(prep_datasets(features, test_data), shuffle=False, device=device)
+    print_log(f"Generated {len(test_data)} testing samples", Fore.BLUE)
 
-    model = WeatherModel(ukmo_var_size=ukmo_var_size,
-                         run_enc_size=run_enc_size,
-                         fcst_enc_size=fcst_enc_size,
-                         fcst_steps=fcst_steps,
-                         d_model=256,
-                         nhead=8,
-                         enc_layers=6,
-                         dec_layers=4,
-                         dim_feedforward=1024,
-                         dropout=0.1)
+    if int8 and device.type != 'cpu':
+        print_log("Quantized model only runs on CPU", Fore.RED)
+        sys.exit(1)
+
+    model = load_model(feature_sizes(features), device, int8)
+    if compiled:
+        compile_model(model)
+
+    # One pass: metrics are accumulated per batch and predictions go to a columnar file, not the terminal
+    metrics = MetricsAccumulator(features['temp'].shape[1])
+    predicted = np.empty(features['temp'].shape, dtype=np.float32)
+    actual = np.empty(features['temp'].shape, dtype=np.float32)
+
+    # One untimed batch of each size first (a full one and the last partial one), so torch.compile and lazy
+    # CUDA/oneDNN setup are not counted as inference time
+    warmup = {}
+    for batch in test_dataset:
+        warmup.setdefault(len(batch[0]), batch)
+    for _ in eval_batches(model, list(warmup.values()), amp=not int8):
+        pass
+
+    offset = 0
+    predict_start = time.perf_counter()
+    for preds, t_temp in eval_batches(model, test_dataset, amp=not int8):
+        metrics.update(preds, t_temp)
+        predicted[offset:offset + len(preds)] = preds.numpy()
+        actual[offset:offset + len(preds)] = t_temp.numpy()
+        offset += len(preds)
+    predict_time = time.perf_counter() - predict_start
+
+    np.savez(TEST_PREDICTIONS_FILE, run_id=np.asarray(features['run_id'], dtype=str), predicted=predicted, actual=actual)
+    report_metrics(metrics.metrics())
+    print_log(f"  Inference: {len(test_data) / predict_time:.0f} samples/s on {device}", Fore.CYAN)
+    print_log(f"Saved per-sample predictions to {TEST_PREDICTIONS_FILE}", Fore.GREEN)
+
+
+def report_metrics(metrics):
+    print_log("Test performance per lead hour:", Fore.YELLOW)
+    print_log(f"{'Lead':>4} {'MAE':>8} {'RMSE':>8} {'Bias':>8} {'R²':>8}", Fore.MAGENTA)
+    for step in range(len(metrics['lead']['mae'])):
+        row = " ".join(f"{metrics['lead'][name][step]:>8.4f}" for name in ['mae', 'rmse', 'bias', 'r2'])
+        print_log(f"{step + 1:>4} {row}", Fore.GREEN)
 
-    params = {'learning_rate': 0.0001, 'epochs': 500, 'l2_reg_weight': 0.001}
+    print_log(f"\nOverall Test Performance:", Fore.YELLOW)
+    print_log(f"  MAE: {metrics['mae']:.4f}", Fore.CYAN)
+    print_log(f"  RMSE: {metrics['rmse']:.4f}", Fore.CYAN)
+    print_log(f"  Bias: {metrics['bias']:.4f}", Fore.CYAN)
+    print_log(f"  R²: {metrics['r2']:.4f}", Fore.CYAN)
 
-    print_log(f"Training Transformer model with params: {params}", Fore.YELLOW)
-    train_model(model, train_dataset, eval_dataset, params)
 
+def cpu_latency(model, sample):
+    # Batch-1 latency of a float32 CPU copy, the way a single forecast is served
+    model = copy.deepcopy(model).to('cpu').eval()
+    sample = [tensor[:1].cpu() for tensor in sample]
 
-def test_transformer(testing_data):
-    test_data = prep_datasets(testing_data)
-    test_dataset = create_dataset(test_data)
-    print_log(f"Generated {len(test_data)} testing samples", Fore.BLUE)
+    latencies = []
+    with torch.inference_mode():
+        for i in range(LATENCY_REPEAT + 10):
+            start = time.perf_counter()
+            model(*sample)
+            if i >= 10:
+                latencies.append(time.perf_counter() - start)
 
-    run_enc_size = len(testing_data[0]['run_hour'])
-    ukmo_var_size = len(testing_data[0]['input'][0])
-    fcst_steps = len(testing_data[0]['output'])
-    fcst_enc_size = len(testing_data[0]['output'][0]['time'])
-
-    model = WeatherModel(ukmo_var_size=ukmo_var_size,
-                         run_enc_size=run_enc_size,
-                         fcst_enc_size=fcst_enc_size,
-                         fcst_steps=fcst_steps,
-                         d_model=256,
-                         nhead=8,
-                         enc_layers=6,
-                         dec_layers=4,
-                         dim_feedforward=1024,
-                         dropout=0.1)
-
-    model.load_state_dict(torch.load(MODEL_FILE))
-    model.to(DEVICE)
-    model.eval()
+    return np.percentile(latencies, 50) * 1000, np.percentile(latencies, 95) * 1000
 
-    print_log("Model Predictions vs Actual Values:", Fore.YELLOW)
-    print_log("=" * 80, Fore.MAGENTA)
 
-    sample_idx = 0
-    with torch.no_grad():
-        for t_run_hour, t_input, t_time, t_temp in test_dataset:
-            t_run_hour = t_run_hour.to(DEVICE, non_blocking=True)
-            t_input = t_input.to(DEVICE, non_blocking=True)
-            t_time = t_time.to(DEVICE, non_blocking=True)
+def student_result(name, model, eval_dataset):
+    metrics = eval_metrics(model, eval_dataset)
+    p50, p95 = cpu_latency(model, next(iter(eval_dataset))[:3])
 
-            with torch.amp.autocast('cuda'):
-                preds = model(t_run_hour, t_input, t_time)
+    return {
+        'name': name,
+        'params': sum(param.numel() for param in model.parameters()),
+        'size': state_dict_size(model) / 1e6,
+        'mae': metrics['mae'],
+        'rmse': metrics['rmse'],
+        'r2': metrics['r2'],
+        'p50': p50,
+        'p95': p95,
+    }
 
-            for i in range(preds.size(0)):
-                predicted_temps = preds[i].cpu().numpy()
-                actual_temps = t_temp[i].numpy()
 
-                print_log(f"\nSample {sample_idx + 1}:", Fore.CYAN)
-                print_log(f"{'Hour':<9} {'Predicted':<12} {'Actual':<12} {'Diff'}", Fore.MAGENTA)
-                print_log("-" * 42, Fore.MAGENTA)
+def report_distill(results):
+    print_log("\nAccuracy vs CPU latency (held-out runs, batch 1):", Fore.YELLOW)
+    print_log(f"{'Model':<8} {'Params':>10} {'Size MB':>8} {'MAE':>8} {'RMSE':>8} {'R²':>8} {'p50 ms':>8} {'p95 ms':>8}",
+              Fore.MAGENTA)
 
-                for j, (pred, actual) in enumerate(zip(predicted_temps, actual_temps)):
-                    diff = abs(pred - actual)
-                    print_log(f"{j:>4}   {pred:>8.2f}     {actual:>8.2f}     {diff:>7.2f}", Fore.GREEN)
+    for result in results:
+        print_log(
+            f"{result['name']:<8} {result['params']:>10,} {result['size']:>8.1f} {result['mae']:>8.4f} {result['rmse']:>8.4f} "
+            f"{result['r2']:>8.4f} {result['p50']:>8.2f} {result['p95']:>8.2f}", Fore.GREEN)
 
-                mae_sample = mean_absolute_error(actual_temps, predicted_temps)
-                r2_sample = r2_score(actual_temps, predicted_temps)
-                print_log(f"Sample MAE: {mae_sample:.4f}, R²: {r2_sample:.4f}", Fore.BLUE)
 
-                sample_idx += 1
+def distill_transformer(features, device, students=None):
+    # Same split as train_transformer, students are scored on the runs the teacher never saw
+    train_data, eval_data = split_indices(features)
+    train_tensors = prep_datasets(features, train_data)
+    eval_dataset = create_dataset(prep_datasets(features, eval_data), shuffle=False, device=device)
+    sizes = feature_sizes(features)
 
-    test_preds, test_targets = eval_model(model, test_dataset)
-    test_mae = mean_absolute_error(test_targets, test_preds)
-    test_r2 = r2_score(test_targets, test_preds)
+    teacher = load_model(sizes, device)
 
-    print_log(f"\nOverall Test Performance:", Fore.YELLOW)
-    print_log(f"  MAE: {test_mae:.4f}", Fore.CYAN)
-    print_log(f"  R²: {test_r2:.4f}", Fore.CYAN)
+    # MSE to the blended target equals the weighted sum of the MSEs to teacher and observation, up to a constant,
+    # so the regular training loop distills without changes
+    teacher_preds, _ = eval_model(teacher, create_dataset(train_tensors, shuffle=False, device=device))
+    observed = train_tensors[-1]
+    soft_temp = DISTILL_ALPHA * torch.from_numpy(teacher_preds).view_as(observed) + (1 - DISTILL_ALPHA) * observed
+    train_dataset = create_dataset((*train_tensors[:-1], soft_temp), device=device)
+    print_log(f"Distilling on {len(train_data)} runs, targets {DISTILL_ALPHA} teacher / {1 - DISTILL_ALPHA:.1f} observed",
+              Fore.CYAN)
+
+    results = [student_result('teacher', teacher, eval_dataset)]
+    Path(STUDENT_DIR).mkdir(parents=True, exist_ok=True)
+
+    for name in students or STUDENT_CONFIGS:
+        torch.manual_seed(0)
+        model = build_model(sizes, STUDENT_CONFIGS[name]).to(device)
+
+        print_log(f"Training student '{name}' with params: {STUDENT_CONFIGS[name]}", Fore.YELLOW)
+        train_model(model, train_dataset, eval_dataset, {**TRAIN_PARAMS, 'model_file': f"{STUDENT_DIR}/{name}.pth"})
+        results.append(student_result(name, model, eval_dataset))
+
+    report_distill(results)
+    print_log(f"Saved students to {STUDENT_DIR}, load with build_model(sizes, STUDENT_CONFIGS[name])", Fore.GREEN)
+
+
+def state_dict_size(model):
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes
+
+
+def quantize_transformer(features):
+    device = torch.device('cpu')
+
+    # Same held-out runs as train_transformer
+    _, eval_data = split_indices(features)
+    eval_dataset = create_dataset(prep_datasets(features, eval_data), shuffle=False)
+    print_log(f"Generated {len(eval_data)} evaluation samples", Fore.BLUE)
+
+    model = load_model(feature_sizes(features), device)
+    quantized = QuantizedWeatherModel(model)
+
+    print_log("Float32 vs dynamic int8 on the held-out set (CPU):", Fore.YELLOW)
+    print_log(f"{'Model':<8} {'MAE':>8} {'R²':>8} {'Samples/s':>10} {'Size MB':>8}", Fore.MAGENTA)
+
+    results = {}
+    for name, candidate in [('float32', model), ('int8', quantized)]:
+        start = time.perf_counter()
+        preds, targets = eval_model(candidate, eval_dataset, amp=False)
+        elapsed = time.perf_counter() - start
+
+        results[name] = preds
+        mae = mean_absolute_error(targets, preds)
+        r2 = r2_score(targets, preds)
+        size = state_dict_size(candidate) / 1e6
+        print_log(f"{name:<8} {mae:>8.4f} {r2:>8.4f} {len(eval_data) / elapsed:>10.0f} {size:>8.1f}", Fore.GREEN)
+
+    drift = np.abs(results['int8'] - results['float32'])
+    print_log(f"int8 vs float32 predictions: mean |diff| {drift.mean():.4f}, max |diff| {drift.max():.4f}", Fore.CYAN)
+
+    torch.save(quantized.state_dict(), QUANTIZED_FILE)
+    print_log(f"Saved quantized model to {QUANTIZED_FILE}", Fore.GREEN)